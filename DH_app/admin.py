@@ -19,12 +19,15 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from django.contrib import admin
 from .models import *
+from DH_app.data.fracture_log import update_fracture_log
+from DH_app.data.rqd import update_rqd
+from DH_app.data.model_registry import set_default
 
 # Register your models here.
 
 @admin.register(Projects)
 class Projects_admin(admin.ModelAdmin):
-    list_display = ("project_name","comments")
+    list_display = ("project_name","comments", "active_model")
 
 @admin.register(General_DH)
 class DH_admin(admin.ModelAdmin):
@@ -44,4 +47,58 @@ class Lithos_admin(admin.ModelAdmin):
 
 @admin.register(Lithos_DH)
 class Lithos_DH_admin(admin.ModelAdmin):
-    list_display = ("DH_id", "From", "To", "Litho_label")
\ No newline at end of file
+    list_display = ("DH_id", "From", "To", "Litho_label")
+
+@admin.register(Images)
+class Images_admin(admin.ModelAdmin):
+    list_display = ("DH_id", "Images", "width", "height", "depth_from", "depth_to", "model_version", "processed_at")
+    list_editable = ("depth_from", "depth_to")
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Al cambiar el tramo de la imagen se actualizan el registro de fracturación y el RQD
+        if {"depth_from", "depth_to"} & set(form.changed_data):
+            # También el tramo anterior: sus filas ya no deben contar esta imagen
+            previous = Images(DH_id=obj.DH_id, depth_from=form.initial.get("depth_from"), depth_to=form.initial.get("depth_to"))
+            for images in ([obj], [previous]):
+                update_fracture_log(obj.DH_id, images=images)
+                update_rqd(obj.DH_id, images=images)
+
+@admin.register(Fracture_DH)
+class Fracture_DH_admin(admin.ModelAdmin):
+    list_display = ("DH_id", "From", "To", "fract_length", "intensity")
+
+@admin.register(RQD_DH)
+class RQD_DH_admin(admin.ModelAdmin):
+    list_display = ("DH_id", "From", "To", "recovery", "RQD", "pieces")
+
+@admin.register(Detections_DH)
+class Detections_DH_admin(admin.ModelAdmin):
+    list_display = ("DH_id", "image", "label", "confidence", "mask_area", "model_version")
+    list_filter = ("label",)
+
+@admin.register(Process_job)
+class Process_job_admin(admin.ModelAdmin):
+    list_display = ("ID", "DH_id", "state", "processed", "total", "worker", "heartbeat", "created", "finished")
+
+@admin.register(Upload_session)
+class Upload_session_admin(admin.ModelAdmin):
+    list_display = ("token", "DH_id", "filename", "offset", "size", "state", "updated")
+    list_filter = ("state",)
+
+@admin.register(DL_model)
+class DL_model_admin(admin.ModelAdmin):
+    list_display = ("name", "version", "is_default", "size", "created")
+    readonly_fields = ("version", "checksum", "file", "size", "is_default")
+    actions = ["make_default"]
+
+    def has_add_permission(self, request):
+        # Los modelos se registran con manage.py register_model (copia y checksum del fichero)
+        return False
+
+    @admin.action(description="Usar como modelo por defecto")
+    def make_default(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, "Seleccione un único modelo.", level="error")
+            return
+        set_default(queryset.first())
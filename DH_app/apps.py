@@ -18,8 +18,17 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 from django.apps import AppConfig
+from django.conf import settings
+import threading
 
 
 class DhAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'DH_app'
+
+    def ready(self):
+        # Precarga opcional del modelo en segundo plano para evitar el arranque en frío
+        if settings.DL_MODEL_WARMUP:
+            from DH_app.data.model_cache import warm_up
+            from DH_app.data.model_registry import active_model_path
+            threading.Thread(target=lambda: warm_up(active_model_path()), name="DL_model_warmup", daemon=True).start()
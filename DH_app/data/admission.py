@@ -0,0 +1,104 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Control de admisión de la inferencia: huecos de ejecución compartidos entre procesos
+(ficheros de bloqueo) y cuota de trabajos por usuario
+'''
+import os, time, logging
+from contextlib import contextmanager
+import torch
+from django.conf import settings
+from DH_app.models import Process_job
+
+try:
+    import fcntl
+except ImportError: # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+
+class InferenceBusy(Exception):
+    pass
+
+
+def _try_lock(slot):
+    os.makedirs(settings.DL_LOCK_DIR, exist_ok=True)
+    f = open(os.path.join(settings.DL_LOCK_DIR, f"inference_{slot}.lock"), "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+    except OSError:
+        f.close()
+        return None
+
+
+def set_worker_threads(threads=None):
+    """
+    Hilos de torch del proceso (por defecto settings.DL_THREADS_PER_SLOT). Es un valor global
+    del proceso, así que se fija una vez al arrancar el worker y no en cada hueco: con varios
+    trabajos simultáneos en el mismo proceso uno cambiaría los hilos del otro a mitad de ejecución.
+    """
+    torch.set_num_threads(threads or settings.DL_THREADS_PER_SLOT)
+
+
+@contextmanager
+def inference_slot(timeout=None):
+    """
+    Reserva uno de los settings.DL_INFERENCE_SLOTS huecos de inferencia del servidor.
+    El bloqueo es de fichero, así que lo comparten todos los procesos (web y workers)
+    y se libera solo si el proceso muere.
+
+        Parámetros:
+            - timeout: Segundos de espera máxima (None: sin límite, 0: no esperar).
+
+        Excepciones:
+            - InferenceBusy si no hay hueco libre antes del timeout.
+    """
+    lock = None
+    if fcntl is not None:
+        start = time.monotonic()
+        while lock is None:
+            for slot in range(settings.DL_INFERENCE_SLOTS):
+                lock = _try_lock(slot)
+                if lock:
+                    break
+            else:
+                if timeout is not None and time.monotonic() - start >= timeout:
+                    raise InferenceBusy("No hay huecos de inferencia libres.")
+                time.sleep(0.5)
+    else:
+        logging.warning("fcntl no disponible: no se limita la inferencia concurrente")
+
+    try:
+        yield
+    finally:
+        if lock:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+
+def over_quota(user):
+    """
+    True si el usuario ya tiene settings.DL_USER_QUOTA trabajos pendientes o en proceso,
+    o si la cola global está llena (settings.DL_MAX_QUEUED).
+    """
+    active = Process_job.objects.filter(state__in=(Process_job.PENDING, Process_job.RUNNING))
+    if active.count() >= settings.DL_MAX_QUEUED:
+        return True
+    return user.is_authenticated and active.filter(user=user).count() >= settings.DL_USER_QUOTA
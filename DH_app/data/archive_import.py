@@ -0,0 +1,193 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Importación de imágenes desde un fichero comprimido (ZIP o TAR) de una campaña completa.
+Los miembros se leen de uno en uno del fichero (sin descomprimirlo antes en disco) y se asignan
+a los sondeos según su ruta:
+    <sondeo>/<cualquier nombre>.jpg   (carpeta con el nombre del sondeo, a cualquier nivel)
+    <sondeo>_<n>.jpg                  (nombre con el del sondeo)
+'''
+import os, io, re, hashlib, zipfile, tarfile, threading, logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from DH_app.models import General_DH, Images
+from DH_app.data.file_manager import create_directory
+from DH_app.data.manifest import register_image
+from DH_app.data.uploads import allocate_numbers, save_image, finish_uploads
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff", ".bmp"}
+NUMBERED = re.compile(r"(.+)_\d+$")
+
+
+def archive_members(fileobj):
+    """
+    Recorre los ficheros de un ZIP o TAR (comprimido o no) sin extraerlos.
+
+        Retorno:
+            - Generador de tuplas (ruta del miembro, objeto de fichero para leerlo).
+
+        Excepciones:
+            - ValueError si no es un fichero ZIP ni TAR.
+    """
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        yield info.filename, member
+        return
+    fileobj.seek(0)
+    try:
+        # Modo "r|*": lectura secuencial del TAR (y gz/bz2/xz) sin volver atrás en el fichero
+        archive = tarfile.open(fileobj=fileobj, mode="r|*")
+    except tarfile.TarError:
+        raise ValueError("El fichero no es un ZIP ni un TAR.")
+    with archive:
+        for info in archive:
+            if info.isfile():
+                yield info.name, archive.extractfile(info)
+
+
+def match_hole(name, holes):
+    """
+    Sondeo de un miembro según la nomenclatura (carpeta o prefijo del nombre del fichero).
+
+        Parámetros:
+            - name: Ruta del miembro dentro del fichero.
+            - holes: Diccionario nombre de sondeo -> General_DH.
+    """
+    parts = name.replace("\\", "/").split("/")
+    for part in reversed(parts[:-1]):
+        if part in holes:
+            return holes[part]
+    match = NUMBERED.match(os.path.splitext(parts[-1])[0])
+    if match and match.group(1) in holes:
+        return holes[match.group(1)]
+    return None
+
+
+def is_image_member(name):
+    # Se ignoran los ficheros ocultos y los metadatos de macOS (__MACOSX, ._*)
+    parts = name.replace("\\", "/").split("/")
+    if any(part.startswith(".") or part == "__MACOSX" for part in parts):
+        return False
+    return os.path.splitext(parts[-1])[1].lower() in IMAGE_EXTENSIONS
+
+
+def import_archive(fileobj, project=None, workers=None, background=True):
+    """
+    Importa las imágenes de un fichero comprimido en sus sondeos. Las imágenes cuyo hash ya
+    está en el sondeo (importadas antes, aunque se convirtieran a JPEG, o repetidas en el
+    fichero) se omiten. Cada imagen se registra en cuanto se guarda, así que un error en una
+    (disco lleno...) no deja en disco imágenes sin registrar.
+
+        Parámetros:
+            - fileobj: Fichero ZIP o TAR abierto en modo binario.
+            - project: Proyecto al que se limita la búsqueda de sondeos (None: todos).
+            - workers: Hilos de escritura (por defecto settings.UPLOAD_WORKERS).
+            - background: Generar miniaturas y preprocesadas en segundo plano (ver finish_uploads).
+
+        Retorno:
+            - Diccionario con el número de imágenes importadas y repetidas por sondeo, y el
+              número de miembros sin sondeo, demasiado grandes, que no son imágenes válidas
+              o que no se han podido guardar.
+    """
+    workers = workers or settings.UPLOAD_WORKERS
+    limit = settings.ARCHIVE_MAX_MEMBER_SIZE
+    holes = General_DH.objects.all()
+    if project:
+        holes = holes.filter(project_id=project)
+    by_name = {}
+    for DH in holes:
+        by_name[DH.DH_id] = by_name[DH.DH_id.replace(" ", "_")] = DH
+
+    report = {"holes": {}, "unmatched": 0, "too_large": 0, "invalid": 0, "failed": 0}
+    known, folders, pending = {}, {}, {}
+    saved = []
+
+    def register(future):
+        # Los registros en la BD se hacen desde el hilo de la importación
+        DH, name, digest = pending.pop(future)
+        try:
+            path, fields = future.result()
+        except ValueError:
+            report["invalid"] += 1
+            return
+        except Exception as e:
+            logging.error(f"No se ha podido guardar {name}: {e}")
+            report["failed"] += 1
+            return
+        if fields["content_hash"] != digest: # Convertida a JPEG: se guarda el hash del original
+            fields = dict(fields, source_hash=digest)
+        register_image(DH, path, fields)
+        saved.append(path)
+        report["holes"][DH.DH_id]["imported"] += 1
+
+    # Limita las imágenes leídas en memoria a la espera de escribirse
+    slots = threading.BoundedSemaphore(2 * workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, member in archive_members(fileobj):
+            if not is_image_member(name):
+                continue
+            DH = match_hole(name, by_name)
+            if DH is None:
+                report["unmatched"] += 1
+                continue
+            counts = report["holes"].setdefault(DH.DH_id, {"imported": 0, "duplicates": 0})
+            if DH.ID not in known:
+                known[DH.ID] = set()
+                for content_hash, source_hash in Images.objects.filter(DH_id=DH).values_list("content_hash", "source_hash"):
+                    known[DH.ID].update((content_hash, source_hash))
+                folders[DH.ID] = os.path.join(create_directory(DH.project_id, DH.DH_id), "images")
+            data = member.read(limit + 1) # Como mucho un byte más del límite
+            if len(data) > limit:
+                report["too_large"] += 1
+                continue
+            digest = hashlib.sha256(data).hexdigest()
+            if digest in known[DH.ID]:
+                counts["duplicates"] += 1
+                continue
+            known[DH.ID].add(digest)
+            number = allocate_numbers(DH, 1, folders[DH.ID])[0]
+            slots.acquire()
+            future = executor.submit(save_image, io.BytesIO(data), os.path.join(folders[DH.ID], f"{DH.DH_id}_{number}"))
+            future.add_done_callback(lambda _: slots.release())
+            pending[future] = (DH, name, digest)
+            for done in [f for f in pending if f.done()]:
+                register(done)
+        for done in as_completed(list(pending)):
+            register(done)
+    finish_uploads(saved, background)
+    return report
+
+
+def report_message(report):
+    # Resumen del informe de import_archive para mostrar al usuario
+    lines = [f"{DH_id}: {c['imported']} importadas, {c['duplicates']} repetidas" for DH_id, c in sorted(report["holes"].items())]
+    if report["unmatched"]:
+        lines.append(f"{report['unmatched']} imágenes sin sondeo")
+    if report["too_large"]:
+        lines.append(f"{report['too_large']} imágenes demasiado grandes")
+    if report["invalid"]:
+        lines.append(f"{report['invalid']} ficheros no válidos")
+    if report["failed"]:
+        lines.append(f"{report['failed']} imágenes no se han podido guardar")
+    return lines or ["No se ha encontrado ninguna imagen."]
@@ -0,0 +1,201 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Subidas por partes reanudables. Protocolo:
+    1. POST upload_session/ (DH_id, filename, size, sha256) -> token y offset (0, o el de una
+       subida anterior del mismo fichero que se quedó a medias).
+    2. PUT upload_session/<token>/ con la cabecera Upload-Offset y los bytes de la parte en el
+       cuerpo, tantas veces como haga falta. Si el offset no coincide se responde 409 con el offset
+       correcto; GET upload_session/<token>/ devuelve el estado para reanudar.
+    3. Al recibir el último byte se comprueba el SHA-256 y la imagen pasa a <sondeo>/images.
+'''
+import os, uuid, shutil, logging
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from django.db.models import Q
+from DH_app.models import Upload_session, Images
+from DH_app.data.file_manager import create_directory, media_path
+from DH_app.data.manifest import file_hash, image_fields, register_image
+from DH_app.data.uploads import allocate_numbers, inspect_upload, DISPLAYABLE, save_image, finish_uploads
+
+CHUNK = 1024 * 1024 # Bloque de lectura del cuerpo de la petición
+
+try:
+    import fcntl
+except ImportError: # Windows: sin bloqueo del fichero parcial (solo la actualización condicionada del offset)
+    fcntl = None
+
+
+class UploadConflict(Exception):
+    # El offset de la parte no coincide con los bytes ya recibidos
+    def __init__(self, offset):
+        super().__init__(f"Offset esperado: {offset}")
+        self.offset = offset
+
+
+def part_path(session):
+    return os.path.join(settings.UPLOAD_SESSION_DIR, f"{session.token}.part")
+
+
+def expire_sessions():
+    # Borra las subidas incompletas sin actividad y sus ficheros parciales
+    limit = timezone.now() - timedelta(hours=settings.UPLOAD_SESSION_EXPIRY)
+    for session in Upload_session.objects.filter(state=Upload_session.OPEN, updated__lt=limit):
+        if os.path.exists(part_path(session)):
+            os.remove(part_path(session))
+        session.delete()
+
+
+def open_session(DH, filename, size, sha256, user=None):
+    """
+    Crea una subida o devuelve la subida abierta del mismo fichero (mismo sondeo, tamaño y hash)
+    para continuarla. Si el sondeo ya tiene una imagen con ese hash se devuelve una subida completa.
+
+        Excepciones:
+            - ValueError si el tamaño o el hash no son válidos.
+    """
+    sha256 = sha256.lower()
+    if not 0 < size <= settings.UPLOAD_SESSION_MAX_SIZE:
+        raise ValueError(f"Tamaño no admitido: {size} bytes")
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        raise ValueError("SHA-256 no válido.")
+    expire_sessions()
+    if user is not None and not user.is_authenticated:
+        user = None
+    session = Upload_session.objects.filter(DH_id=DH, size=size, sha256=sha256, state=Upload_session.OPEN).first()
+    if session:
+        return session
+    existing = Images.objects.filter(Q(content_hash=sha256) | Q(source_hash=sha256), DH_id=DH).first()
+    session = Upload_session.objects.create(token=uuid.uuid4().hex, DH_id=DH, user=user, filename=os.path.basename(filename),
+                                            size=size, sha256=sha256)
+    if existing:
+        Upload_session.objects.filter(ID=session.ID).update(state=Upload_session.COMPLETE, offset=size, image=existing.Images.name)
+        session.refresh_from_db()
+    else:
+        os.makedirs(settings.UPLOAD_SESSION_DIR, exist_ok=True)
+        open(part_path(session), "wb").close()
+    return session
+
+
+def write_chunk(session, offset, stream, length):
+    """
+    Escribe una parte en el fichero parcial a partir de offset, leyendo el cuerpo por bloques.
+    La comprobación del offset, la escritura y su actualización se hacen con un bloqueo
+    exclusivo (flock) del fichero parcial: si otro PUT de la misma sesión está escribiendo
+    (p.ej. el original de un reintento tras un timeout) se responde con un conflicto.
+
+        Excepciones:
+            - UploadConflict si offset no es el número de bytes ya recibidos o hay otra
+              parte escribiéndose.
+            - ValueError si la parte excede el tamaño declarado.
+    """
+    session.refresh_from_db()
+    if session.state != Upload_session.OPEN:
+        raise UploadConflict(session.offset)
+    try:
+        f = open(part_path(session), "r+b")
+    except FileNotFoundError: # Completada o expirada mientras tanto
+        session.refresh_from_db()
+        raise UploadConflict(session.offset)
+    with f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadConflict(session.offset)
+        session.refresh_from_db()
+        if session.state != Upload_session.OPEN or offset != session.offset:
+            raise UploadConflict(session.offset)
+        if offset + length > session.size:
+            raise ValueError("La parte excede el tamaño del fichero.")
+        written = 0
+        f.seek(offset)
+        while written < length:
+            data = stream.read(min(CHUNK, length - written))
+            if not data: # Conexión cortada: se guarda lo recibido
+                break
+            f.write(data)
+            written += len(data)
+        f.truncate(offset + written)
+        f.flush()
+        if not Upload_session.objects.filter(ID=session.ID, offset=offset).update(offset=offset + written):
+            session.refresh_from_db()
+            raise UploadConflict(session.offset)
+        session.refresh_from_db()
+        # Con el bloqueo: ningún otro PUT puede completar la misma sesión a la vez
+        if session.offset == session.size:
+            complete_session(session)
+    return session
+
+
+def complete_session(session):
+    """
+    Comprueba el hash del fichero recibido y lo guarda como imagen del sondeo.
+    Si el hash no coincide la subida queda con error y hay que repetirla.
+    """
+    part = part_path(session)
+    if file_hash(part) != session.sha256:
+        os.remove(part)
+        Upload_session.objects.filter(ID=session.ID).update(state=Upload_session.FAILED, error="El SHA-256 no coincide.")
+        session.refresh_from_db()
+        return session
+    DH = session.DH_id
+    folder = os.path.join(create_directory(DH.project_id, DH.DH_id), "images")
+    stem = os.path.join(folder, f"{DH.DH_id}_{allocate_numbers(DH, 1, folder)[0]}")
+    try:
+        with open(part, "rb") as f:
+            fmt, _ = inspect_upload(f)
+            if fmt in DISPLAYABLE:
+                path = stem + DISPLAYABLE[fmt]
+                fields = None
+            else:
+                path, fields = save_image(f, stem)
+        if fields is None:
+            shutil.move(part, path) # Sin copia si están en el mismo sistema de ficheros
+            fields = image_fields(path)
+        else:
+            fields["source_hash"] = session.sha256
+            os.remove(part)
+    except ValueError as e:
+        if os.path.exists(part):
+            os.remove(part)
+        Upload_session.objects.filter(ID=session.ID).update(state=Upload_session.FAILED, error=str(e))
+        session.refresh_from_db()
+        return session
+    register_image(DH, path, fields)
+    finish_uploads([path])
+    Upload_session.objects.filter(ID=session.ID).update(state=Upload_session.COMPLETE, image=media_path(path))
+    logging.info(f"Subida {session.token} completa: {path}")
+    session.refresh_from_db()
+    return session
+
+
+def session_status(session):
+    return {
+        "session": session.token,
+        "DH_id": session.DH_id.DH_id,
+        "filename": session.filename,
+        "size": session.size,
+        "offset": session.offset,
+        "state": session.state,
+        "image": session.image,
+        "error": session.error,
+    }
@@ -0,0 +1,82 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Almacenamiento y consulta de las detecciones del modelo en la BD
+'''
+import numpy as np
+from django.db import transaction
+from django.db.models import Count, Sum, Avg
+from DH_app.models import Images, Detections_DH
+from DH_app.data.file_manager import media_path
+from DH_app.data.mask_store import rasterize
+
+
+def mask_area(det):
+    # Área (px) de la unión de los contornos de una detección
+    if not det["polygons"]:
+        return 0.0
+    mask, _ = rasterize(det)
+    return float(np.count_nonzero(mask))
+
+
+def image_row(DH, image_path):
+    """
+    Devuelve el registro de Images de una imagen del sondeo, creándolo si no existe.
+    """
+    image, _ = Images.objects.get_or_create(DH_id=DH, project_id=DH.project_id, Images=media_path(image_path))
+    return image
+
+
+def save_detections(DH, detections, model_version):
+    """
+    Guarda las detecciones de un lote de imágenes con una única inserción masiva.
+    Las detecciones anteriores de esas imágenes se sustituyen.
+
+        Parámetros:
+            - DH: Sondeo (General_DH).
+            - detections: Diccionario {path de la imagen: lista de detecciones}.
+            - model_version: Versión del modelo que generó las detecciones.
+    """
+    rows = []
+    with transaction.atomic():
+        images = [image_row(DH, path) for path in detections]
+        Detections_DH.objects.filter(image__in=images).delete()
+        for image, dets in zip(images, detections.values()):
+            for det in dets:
+                x1, y1, x2, y2 = [float(v) for v in det["box"]]
+                rows.append(Detections_DH(
+                    DH_id=DH, image=image, label=det["label"], class_id=det["cls"], confidence=det["conf"],
+                    x1=x1, y1=y1, x2=x2, y2=y2, mask_area=mask_area(det), model_version=model_version))
+        Detections_DH.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+def detection_summary(DH, label=None):
+    """
+    Resumen por clase de las detecciones de un sondeo (una sola consulta).
+
+        Retorno:
+            - Lista de diccionarios con label, count, mask_area y confidence medios.
+    """
+    data = Detections_DH.objects.filter(DH_id=DH)
+    if label:
+        data = data.filter(label=label)
+    return list(data.values("label").annotate(
+        count=Count("ID"), mask_area=Sum("mask_area"), confidence=Avg("confidence")).order_by("label"))
@@ -42,9 +42,17 @@ def create_directory(project,DH=None):
             pass
     return folder_path
 
+def hole_directory(project, DH):
+    # Carpeta de un sondeo, sin crearla
+    return os.path.join(settings.MEDIA_ROOT, str(project).replace(" ", "_"), str(DH).replace(" ", "_"))
+
 def delete_directory(project, DH=None):
     if DH:
         folder_path =os.path.join(settings.MEDIA_ROOT,str(project),str(DH))
     else:
         folder_path =os.path.join(settings.MEDIA_ROOT,str(project))
-    shutil.rmtree(folder_path, ignore_errors=True)
\ No newline at end of file
+    shutil.rmtree(folder_path, ignore_errors=True)
+
+def media_path(path):
+    # Path relativo a MEDIA_ROOT (el que se guarda en la BD y se usa con MEDIA_URL)
+    return os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, "/")
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Registro de fracturación en profundidad a partir de las detecciones del modelo
+'''
+import math
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from DH_app.models import Images, Detections_DH, Fracture_DH
+from DH_app.data.file_manager import media_path
+
+FRACTURE = "Alta_fracturacion"
+CORE = "Testigo"
+MARKER = "Cota"
+
+
+def vertical_overlap(boxes, rows):
+    # Fracción de la altura de cada caja (N) que solapa con cada fila (R) -> matriz NxR
+    top = np.maximum(boxes[:, None, 1], rows[None, :, 1])
+    bottom = np.minimum(boxes[:, None, 3], rows[None, :, 3])
+    heights = np.maximum(boxes[:, 3] - boxes[:, 1], 1e-6)
+    return np.clip(bottom - top, 0, None) / heights[:, None]
+
+
+def core_axis(rows, markers):
+    """
+    Eje de longitud de testigo de una imagen. Las filas de testigo se recorren de arriba a
+    abajo y de izquierda a derecha; los tacos (Cota) no son testigo y se descuentan.
+
+        Retorno:
+            - Función position(x, row) que convierte coordenadas x de una fila en longitud
+              acumulada (px) y longitud total de testigo de la imagen (px).
+    """
+    in_row = vertical_overlap(markers, rows) > 0.5
+    # Extensión de cada taco recortada a cada fila (K x R)
+    m_x1 = np.clip(markers[:, None, 0], rows[None, :, 0], rows[None, :, 2])
+    m_x2 = np.clip(markers[:, None, 2], rows[None, :, 0], rows[None, :, 2])
+
+    def removed(x, row):
+        # Ancho de tacos a la izquierda de x en la fila row (vectorizado sobre x)
+        widths = np.clip(np.minimum(x[:, None], m_x2[:, row].T) - m_x1[:, row].T, 0, None)
+        return (widths * in_row[:, row].T).sum(axis=1)
+
+    ends = rows[:, 2]
+    lengths = ends - rows[:, 0] - removed(ends, np.arange(len(rows)))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+    def position(x, row):
+        x = np.clip(x, rows[row, 0], rows[row, 2])
+        return starts[row] + x - rows[row, 0] - removed(x, row)
+
+    return position, lengths.sum()
+
+
+def image_intervals(boxes, labels, width, height, depth_from, depth_to):
+    """
+    Tramos en profundidad con alta fracturación de una imagen.
+
+        Parámetros:
+            - boxes: Array Nx4 con las cajas (x1, y1, x2, y2) de las detecciones.
+            - labels: Array N con el nombre de la clase de cada detección.
+            - width, height: Tamaño de la imagen (si no hay filas de testigo detectadas se usa
+              la imagen completa como una única fila).
+            - depth_from, depth_to: Tramo del sondeo que aparece en la imagen.
+
+        Retorno:
+            - Arrays (desde, hasta) en metros.
+    """
+    rows = boxes[labels == CORE]
+    if not len(rows):
+        rows = np.array([[0, 0, width, height]], dtype=float)
+    rows = rows[np.lexsort((rows[:, 0], (rows[:, 1] + rows[:, 3]) / 2))]
+    fractures = boxes[labels == FRACTURE]
+    if not len(fractures):
+        return np.zeros(0), np.zeros(0)
+
+    position, total = core_axis(rows, boxes[labels == MARKER])
+    row = vertical_overlap(fractures, rows).argmax(axis=1)
+    scale = (depth_to - depth_from) / max(total, 1e-6)
+    start = depth_from + position(fractures[:, 0], row) * scale
+    end = depth_from + position(fractures[:, 2], row) * scale
+    return start, end
+
+
+def union(starts, ends):
+    # Unión de intervalos solapados (vectorizado con el máximo acumulado de los finales)
+    if not len(starts):
+        return starts, ends
+    order = np.argsort(starts)
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+    new = np.concatenate([[True], starts[1:] > ends[:-1]])
+    return starts[new], np.maximum.reduceat(ends, np.flatnonzero(new))
+
+
+def binned_length(starts, ends, edges):
+    # Longitud de los intervalos dentro de cada tramo [edges[i], edges[i+1])
+    if not len(starts):
+        return np.zeros(len(edges) - 1)
+    lo = np.maximum(starts[:, None], edges[None, :-1])
+    hi = np.minimum(ends[:, None], edges[None, 1:])
+    return np.clip(hi - lo, 0, None).sum(axis=0)
+
+
+def affected_window(DH, step, paths=None, images=None):
+    """
+    Tramos de longitud step que cubren las imágenes indicadas e imágenes del sondeo que los solapan.
+
+        Parámetros:
+            - DH: Sondeo (General_DH).
+            - step: Longitud de los tramos (m).
+            - paths: Paths de las imágenes nuevas o reprocesadas.
+            - images: Alternativamente, registros de Images.
+
+        Retorno:
+            - Tupla (límites de los tramos, lista de Images) o None si ninguna imagen tiene tramo.
+    """
+    if images is None:
+        images = Images.objects.filter(DH_id=DH, Images__in=[media_path(p) for p in paths or []])
+    ranges = [(i.depth_from, i.depth_to) for i in images if i.depth_from is not None and i.depth_to is not None]
+    if not ranges:
+        return None
+    low = math.floor(min(r[0] for r in ranges) / step) * step
+    high = math.ceil(max(r[1] for r in ranges) / step) * step
+    edges = np.arange(low, high + step / 2, step)
+    # Imágenes (nuevas y ya procesadas) que solapan los tramos afectados
+    window = list(Images.objects.filter(DH_id=DH, depth_from__lt=high, depth_to__gt=low, depth_from__isnull=False))
+    return edges, window
+
+
+def update_fracture_log(DH, paths=None, images=None):
+    """
+    Recalcula el registro de fracturación en los tramos que cubren las imágenes indicadas.
+    Solo se leen las imágenes y detecciones que solapan esos tramos, no el sondeo completo.
+
+        Parámetros:
+            - DH: Sondeo (General_DH).
+            - paths: Paths de las imágenes nuevas o reprocesadas.
+            - images: Alternativamente, registros de Images.
+    """
+    affected = affected_window(DH, settings.FRACTURE_LOG_STEP, paths, images)
+    if affected is None:
+        return 0
+    edges, window = affected
+    low, high = edges[0], edges[-1]
+    # Solo cuentan las imágenes procesadas: en las demás la falta de detecciones no es falta de fracturas
+    window = [image for image in window if image.model_version]
+    detections = {}
+    for image_id, label, x1, y1, x2, y2 in Detections_DH.objects.filter(image__in=window).values_list(
+            "image_id", "label", "x1", "y1", "x2", "y2"):
+        detections.setdefault(image_id, []).append((label, (x1, y1, x2, y2)))
+
+    f_starts, f_ends = [], []
+    for image in window:
+        dets = detections.get(image.ID, [])
+        if not dets:
+            continue
+        labels = np.array([d[0] for d in dets])
+        boxes = np.array([d[1] for d in dets], dtype=float)
+        start, end = image_intervals(boxes, labels, boxes[:, 2].max(), boxes[:, 3].max(), image.depth_from, image.depth_to)
+        f_starts.append(start)
+        f_ends.append(end)
+    fract = binned_length(*union(np.concatenate(f_starts or [np.zeros(0)]), np.concatenate(f_ends or [np.zeros(0)])), edges)
+    covered = binned_length(*union(np.array([i.depth_from for i in window]), np.array([i.depth_to for i in window])), edges)
+
+    rows = [Fracture_DH(DH_id=DH, From=float(a), To=float(b), fract_length=float(f), intensity=float(min(f / c, 1)))
+            for a, b, f, c in zip(edges[:-1], edges[1:], fract, covered) if c > 0]
+    with transaction.atomic():
+        Fracture_DH.objects.filter(DH_id=DH, From__gte=low, To__lte=high).delete()
+        Fracture_DH.objects.bulk_create(rows)
+    return len(rows)
@@ -0,0 +1,104 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Servidor de inferencia en el proceso: agrupa en micro-lotes las imágenes de peticiones
+concurrentes y las ejecuta con una única instancia del modelo
+'''
+import time, queue, threading, logging
+from concurrent.futures import Future
+from django.conf import settings
+from DH_app.data.model_cache import get_model
+from DH_app.data.admission import inference_slot
+
+_servers = {}
+_lock = threading.Lock()
+
+
+class InferenceServer:
+    """
+    Cola de imágenes atendida por un único hilo que llama al modelo.
+
+    Cada lote se cierra al llegar a max_batch imágenes o al pasar max_wait segundos desde
+    la primera imagen del lote. Como solo este hilo usa el modelo, las peticiones concurrentes
+    no compiten con varios pools de hilos de torch. El hueco de inferencia del servidor
+    (admission.inference_slot) se reserva solo mientras se ejecuta cada lote, así que todos
+    los trabajos del proceso pueden ir llenando los lotes.
+    """
+
+    def __init__(self, model_path, max_batch=None, max_wait=None):
+        self.model_path = model_path
+        self.max_batch = max_batch or settings.DL_SERVER_MAX_BATCH
+        self.max_wait = settings.DL_SERVER_MAX_WAIT if max_wait is None else max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="DL_inference_server", daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """
+        Añade una imagen (path o array BGR) a la cola.
+
+            Retorno:
+                - Future con el objeto Results de ultralytics de la imagen.
+        """
+        future = Future()
+        self.queue.put((image, future))
+        return future
+
+    def __call__(self, source, stream=False, verbose=False):
+        # Misma interfaz que el modelo YOLO: lista de imágenes -> resultados en el mismo orden
+        futures = [self.submit(image) for image in (source if isinstance(source, list) else [source])]
+        results = (future.result() for future in futures)
+        return results if stream else list(results)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                model = get_model(self.model_path)
+                with inference_slot():
+                    results = model([image for image, _ in batch], verbose=False)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                logging.error(f"Error en el servidor de inferencia: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def get_server(model_path):
+    # Un servidor (y un hilo) por modelo y proceso
+    with _lock:
+        if model_path not in _servers:
+            _servers[model_path] = InferenceServer(model_path)
+        return _servers[model_path]
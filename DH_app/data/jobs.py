@@ -0,0 +1,163 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Cola de trabajos de procesado de imágenes guardada en la BD (sin broker externo)
+'''
+import os, time, logging, threading
+from contextlib import nullcontext
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from DH_app.models import Process_job
+from DH_app.data.file_manager import create_directory
+from DH_app.data.process_images import process_imgs
+from DH_app.data.model_cache import model_version
+from DH_app.data.model_registry import current_model_path, start_watcher
+from DH_app.data.admission import inference_slot, over_quota, InferenceBusy, set_worker_threads
+
+ACTIVE_STATES = (Process_job.PENDING, Process_job.RUNNING)
+
+
+def enqueue_job(DH, user=None):
+    """
+    Añade a la cola el procesado de las imágenes de un sondeo.
+    Si el sondeo ya tiene un trabajo pendiente o en proceso se devuelve ese trabajo.
+    Lanza InferenceBusy si el usuario supera su cuota o la cola está llena.
+    """
+    requeue_running() # Un trabajo de un worker muerto no debe bloquear el sondeo
+    job = Process_job.objects.filter(DH_id=DH, state__in=ACTIVE_STATES).first()
+    if job:
+        return job
+    if user is not None and over_quota(user):
+        raise InferenceBusy("Se ha alcanzado el límite de trabajos de procesado.")
+    if user is not None and not user.is_authenticated:
+        user = None
+    return Process_job.objects.create(DH_id=DH, user=user)
+
+
+def claim_job(worker):
+    """
+    Reserva el trabajo pendiente más antiguo. La actualización condicionada al estado
+    garantiza que dos workers no puedan reservar el mismo trabajo.
+    """
+    for job in Process_job.objects.filter(state=Process_job.PENDING).order_by("created")[:10]:
+        claimed = Process_job.objects.filter(ID=job.ID, state=Process_job.PENDING).update(
+            state=Process_job.RUNNING, worker=worker, started=timezone.now(), heartbeat=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def requeue_running(worker_prefix=None):
+    """
+    Devuelve a la cola los trabajos interrumpidos: los que llevan más de settings.DL_JOB_STALE
+    segundos sin señal de vida (worker muerto, p.ej. por falta de memoria) y, si se indica,
+    los de los workers cuyo nombre empieza por worker_prefix (al parar esos workers).
+    Los trabajos de otros workers vivos no se tocan.
+    """
+    stale = Q(heartbeat__lt=timezone.now() - timedelta(seconds=settings.DL_JOB_STALE)) | Q(heartbeat__isnull=True)
+    if worker_prefix:
+        stale |= Q(worker__startswith=worker_prefix)
+    return Process_job.objects.filter(stale, state=Process_job.RUNNING).update(state=Process_job.PENDING, worker="")
+
+
+def heartbeat(job_id, stop):
+    # Señal de vida del trabajo mientras se ejecuta (una imagen puede tardar más que DL_JOB_STALE)
+    try:
+        while not stop.wait(settings.DL_JOB_HEARTBEAT):
+            Process_job.objects.filter(ID=job_id, state=Process_job.RUNNING).update(heartbeat=timezone.now())
+    finally:
+        connection.close()
+
+
+def run_job(job):
+    DH = job.DH_id
+    path = create_directory(DH.project_id, DH.DH_id)
+
+    def progress(processed, total):
+        Process_job.objects.filter(ID=job.ID).update(processed=processed, total=total, heartbeat=timezone.now())
+
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(job.ID, stop), daemon=True).start()
+    try:
+        # Modelo activo del proyecto ya cargado por el worker (ver model_registry.start_watcher)
+        model_path = current_model_path(DH.project_id)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"El modelo {model_path} no existe.")
+        Process_job.objects.filter(ID=job.ID).update(model_version=model_version(model_path))
+        # Espera a que haya un hueco de inferencia libre en el servidor. Con DL_DYNAMIC_BATCHING
+        # el hueco lo reserva el servidor de inferencia en cada lote (los trabajos del proceso
+        # comparten los lotes y no deben bloquearse entre sí)
+        with nullcontext() if settings.DL_DYNAMIC_BATCHING else inference_slot():
+            process_imgs(path, model_path, progress=progress, DH=DH)
+        Process_job.objects.filter(ID=job.ID).update(state=Process_job.DONE, finished=timezone.now())
+    except Exception as e:
+        logging.error(f"Error en el trabajo {job.ID}: {e}")
+        Process_job.objects.filter(ID=job.ID).update(state=Process_job.FAILED, error=str(e), finished=timezone.now())
+    finally:
+        stop.set()
+
+
+def work(worker, poll_interval=2):
+    """
+    Bucle de un worker: reserva y ejecuta trabajos hasta que se interrumpe el proceso.
+    """
+    logging.info(f"Worker {worker} iniciado")
+    while True:
+        job = claim_job(worker)
+        if job is None:
+            # Sin trabajo: se recuperan los de workers muertos
+            requeue_running()
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+
+
+def work_threads(worker, poll_interval=2, threads=1):
+    """
+    Ejecuta varios bucles de worker en hilos del mismo proceso. Con DL_DYNAMIC_BATCHING
+    las imágenes de los trabajos simultáneos comparten el servidor de inferencia.
+    """
+    start_watcher()
+    set_worker_threads()
+    if threads <= 1:
+        return work(worker, poll_interval)
+    loops = [threading.Thread(target=work, args=(f"{worker}-t{i}", poll_interval), daemon=True) for i in range(threads)]
+    for loop in loops:
+        loop.start()
+    for loop in loops:
+        loop.join()
+
+
+def job_status(job):
+    return {
+        "job": job.ID,
+        "DH_id": job.DH_id.DH_id,
+        "state": job.state,
+        "processed": job.processed,
+        "total": job.total,
+        "error": job.error,
+        "model_version": job.model_version,
+        "position": Process_job.objects.filter(state=Process_job.PENDING, created__lt=job.created).count()
+                    if job.state == Process_job.PENDING else 0,
+    }
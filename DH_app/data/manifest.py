@@ -0,0 +1,118 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Manifiesto de imágenes procesadas: hash del contenido y versión del modelo de cada imagen
+'''
+import os, json, hashlib
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from DH_app.models import Images
+from DH_app.data.file_manager import media_path
+from DH_app.data.result_cache import perceptual_hash
+from DH_app.data.thumbnails import image_size
+from DH_app.data.preprocess import input_transform
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def image_fields(path):
+    # Hashes y metadatos del fichero (no usa la BD, se puede calcular en otros hilos)
+    stat = os.stat(path)
+    try:
+        width, height = image_size(path)
+    except Exception: # No es una imagen (Thumbs.db, .DS_Store...)
+        width, height = None, None
+    return {"content_hash": file_hash(path), "phash": perceptual_hash(path) if width else "", "width": width, "height": height,
+            "file_size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def register_image(DH, path, fields=None):
+    """
+    Registra (o actualiza) una imagen del sondeo en el manifiesto con su hash, su hash
+    perceptual y los metadatos del fichero (fields, si ya se han calculado con image_fields).
+    """
+    image, _ = Images.objects.update_or_create(
+        DH_id=DH, Images=media_path(path),
+        defaults=dict(fields or image_fields(path), project_id=DH.project_id))
+    return image
+
+
+def sync_manifest(DH, images_path):
+    """
+    Sincroniza el manifiesto con la carpeta de imágenes del sondeo.
+    Solo se calcula el hash de las imágenes nuevas o cuyo tamaño/fecha ha cambiado (o sin
+    dimensiones, registradas antes de guardarlas); los registros de imágenes borradas se eliminan.
+    Los ficheros que no son imágenes (Thumbs.db, .DS_Store...) no se registran.
+
+        Retorno:
+            - Tupla (imágenes registradas o actualizadas, registros eliminados).
+    """
+    rows = {image.Images.name: image for image in Images.objects.filter(DH_id=DH)}
+    on_disk = set()
+    updated = 0
+    for entry in os.scandir(images_path):
+        if not entry.is_file():
+            continue
+        name = media_path(entry.path)
+        stat = entry.stat()
+        row = rows.get(name)
+        if row is None or row.file_size != stat.st_size or row.mtime_ns != stat.st_mtime_ns or row.width is None:
+            fields = image_fields(entry.path)
+            if fields["width"] is None: # No es una imagen: no se registra (y se borra si lo estaba)
+                continue
+            register_image(DH, entry.path, fields)
+            updated += 1
+        on_disk.add(name)
+    removed = [row.ID for name, row in rows.items() if name not in on_disk]
+    if removed:
+        Images.objects.filter(ID__in=removed).delete()
+    return updated, len(removed)
+
+
+def pending_images(DH, model_version):
+    """
+    Imágenes del sondeo pendientes de procesar: nuevas, modificadas o procesadas con otro modelo.
+    Es una única consulta sobre el índice (DH_id, model_version), sin listar directorios.
+    """
+    return Images.objects.filter(DH_id=DH, width__isnull=False).exclude(model_version=model_version, processed_hash=F("content_hash"))
+
+
+def mark_processed(DH, paths, model_version):
+    names = [media_path(path) for path in paths]
+    Images.objects.filter(DH_id=DH, Images__in=names).update(processed_hash=F("content_hash"), model_version=model_version,
+                                                            processed_at=timezone.now())
+    # Transformación a la imagen de inferencia, para llevar las detecciones a la foto (preprocess.to_original)
+    for path, name in zip(paths, names):
+        transform = input_transform(path)
+        if transform is not None:
+            matrix, (width, height) = transform
+            Images.objects.filter(DH_id=DH, Images=name).update(input_transform=json.dumps(matrix.tolist()),
+                                                                input_width=width, input_height=height)
+
+
+def image_path(image):
+    return os.path.join(settings.MEDIA_ROOT, image.Images.name)
@@ -0,0 +1,128 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Almacén compacto de máscaras de segmentación.
+
+Cada imagen tiene un contenedor <sondeo>/masks/<imagen>.bin con las máscaras recortadas a
+su caja y empaquetadas a 1 bit por píxel (np.packbits), una tras otra, y un índice
+<imagen>.json con la clase, caja, posición y tamaño de cada una. La lectura usa np.memmap,
+así que solo se cargan de disco las máscaras que se piden.
+'''
+import os, json
+import numpy as np
+import cv2 as cv
+
+
+def mask_paths(image_path):
+    folder, name = os.path.split(image_path)
+    masks_dir = os.path.join(os.path.dirname(folder), "masks")
+    stem = os.path.splitext(name)[0]
+    return os.path.join(masks_dir, stem + ".bin"), os.path.join(masks_dir, stem + ".json")
+
+
+def rasterize(det):
+    """
+    Máscara binaria de una detección (unión de sus contornos) recortada a su caja.
+
+        Retorno:
+            - Tupla (máscara uint8 de alto x ancho de la caja, (x1, y1) de la caja).
+    """
+    x1, y1 = np.floor(det["box"][:2]).astype(int)
+    x2, y2 = np.ceil(det["box"][2:]).astype(int)
+    x1, y1 = max(x1, 0), max(y1, 0)
+    canvas = np.zeros((max(y2 - y1, 1), max(x2 - x1, 1)), dtype=np.uint8)
+    polygons = [(p - [x1, y1]).astype(np.int32) for p in det["polygons"] if len(p)]
+    if polygons:
+        cv.fillPoly(canvas, polygons, 1)
+    return canvas, (int(x1), int(y1))
+
+
+def write_masks(image_path, detections, model_version=""):
+    """
+    Guarda las máscaras de las detecciones de una imagen (sustituye las anteriores).
+    Cada entrada del índice lleva la versión del modelo que la generó.
+    """
+    bin_path, index_path = mask_paths(image_path)
+    os.makedirs(os.path.dirname(bin_path), exist_ok=True)
+    index, offset = [], 0
+    with open(bin_path + ".tmp", "wb") as f:
+        for det in detections:
+            if not det["polygons"]:
+                continue
+            mask, (x, y) = rasterize(det)
+            packed = np.packbits(mask, axis=None)
+            f.write(packed.tobytes())
+            index.append({"cls": det["cls"], "label": det["label"], "conf": det["conf"],
+                          "x": x, "y": y, "height": mask.shape[0], "width": mask.shape[1],
+                          "offset": offset, "nbytes": packed.size, "model_version": model_version})
+            offset += packed.size
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    # Sustitución atómica para que un lector no vea un contenedor a medio escribir
+    os.replace(bin_path + ".tmp", bin_path)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def read_index(image_path):
+    _, index_path = mask_paths(image_path)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def read_masks(image_path, labels=None, region=None, min_conf=0):
+    """
+    Lee las máscaras de una imagen filtrando por clase, región y confianza.
+
+        Parámetros:
+            - labels: Nombres de clase a leer (None: todas).
+            - region: Caja (x1, y1, x2, y2); solo se leen las máscaras que la cortan.
+            - min_conf: Confianza mínima.
+
+        Retorno:
+            - Lista de tuplas (entrada del índice, máscara booleana alto x ancho de su caja).
+    """
+    bin_path, _ = mask_paths(image_path)
+    entries = [e for e in read_index(image_path)
+               if (labels is None or e["label"] in labels) and e["conf"] >= min_conf and
+               (region is None or (e["x"] < region[2] and e["x"] + e["width"] > region[0] and
+                                   e["y"] < region[3] and e["y"] + e["height"] > region[1]))]
+    if not entries:
+        return []
+    data = np.memmap(bin_path, dtype=np.uint8, mode="r")
+    masks = []
+    for e in entries:
+        bits = np.unpackbits(data[e["offset"]:e["offset"] + e["nbytes"]], count=e["height"] * e["width"])
+        masks.append((e, bits.reshape(e["height"], e["width"]).astype(bool)))
+    return masks
+
+
+def class_mask(image_path, label, shape, min_conf=0):
+    """
+    Unión de las máscaras de una clase en una imagen de tamaño shape (alto, ancho).
+    """
+    canvas = np.zeros(shape[:2], dtype=bool)
+    for e, mask in read_masks(image_path, labels=[label], min_conf=min_conf):
+        y, x = e["y"], e["x"]
+        h, w = min(mask.shape[0], shape[0] - y), min(mask.shape[1], shape[1] - x)
+        if h > 0 and w > 0:
+            canvas[y:y + h, x:x + w] |= mask[:h, :w]
+    return canvas
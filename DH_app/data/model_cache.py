@@ -0,0 +1,179 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Caché de modelos YOLO por proceso (worker)
+'''
+import os, json, threading, logging, hashlib
+from collections import OrderedDict
+import numpy as np
+from django.conf import settings
+from ultralytics import YOLO
+
+# clave (path, mtime, tamaño) -> (modelo, tamaño estimado en bytes)
+_models = OrderedDict()
+# clave (path, mtime, tamaño) -> versión (hash) del fichero de pesos
+_versions = {}
+_lock = threading.Lock()
+# Las cargas se hacen fuera de _lock para que los modelos ya cargados se sigan sirviendo
+_load_lock = threading.Lock()
+
+
+def _model_key(model_path):
+    stat = os.stat(model_path)
+    return (os.path.abspath(model_path), stat.st_mtime_ns, stat.st_size)
+
+
+def _model_size(model, model_path):
+    """
+    Estima la memoria ocupada por un modelo a partir de sus parámetros.
+    Si no se puede acceder a ellos se usa el tamaño del fichero de pesos.
+    """
+    try:
+        return sum(p.numel() * p.element_size() for p in model.model.parameters())
+    except Exception:
+        return os.path.getsize(model_path)
+
+
+def _evict(max_models, max_bytes):
+    # Se eliminan los modelos menos usados hasta cumplir los límites (siempre queda al menos uno)
+    while len(_models) > 1 and (len(_models) > max_models or sum(size for _, size in _models.values()) > max_bytes):
+        key, _ = _models.popitem(last=False)
+        logging.info(f"Modelo {key[0]} eliminado de la caché")
+
+
+# Formatos de exportación soportados y path del artefacto junto al .pt (nomenclatura de ultralytics)
+EXPORT_BACKENDS = {
+    "onnx": lambda stem: f"{stem}.onnx",
+    "openvino": lambda stem: f"{stem}_openvino_model",
+}
+
+
+# Tamaño de lote dinámico: process_imgs envía lotes de DL_BATCH_SIZE imágenes o teselas y un
+# grafo exportado con lote 1 (el valor por defecto de ultralytics) los rechaza al inferir
+EXPORT_ARGS = {"dynamic": True}
+
+
+def exported_path(model_path, backend):
+    return EXPORT_BACKENDS[backend](os.path.splitext(model_path)[0])
+
+
+def _export_marker(path):
+    # Parámetros con los que se exportó el artefacto (los exportados antes con lote fijo se rehacen)
+    return f"{path}.export.json"
+
+
+def export_model(model_path, backend):
+    """
+    Exporta los pesos .pt al formato de inferencia en CPU indicado (onnx, openvino).
+    El artefacto se guarda junto al .pt y solo se vuelve a exportar si el .pt es más reciente
+    o se exportó con otros parámetros (EXPORT_ARGS).
+
+        Retorno:
+            - Path al modelo exportado.
+    """
+    path = exported_path(model_path, backend)
+    marker = _export_marker(path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(model_path) and os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == EXPORT_ARGS:
+                return path
+    logging.info(f"Exportando {model_path} a {backend}")
+    exported = YOLO(model_path).export(format=backend, **EXPORT_ARGS) or path
+    with open(marker, "w") as f:
+        json.dump(EXPORT_ARGS, f)
+    return exported
+
+
+def _load(model_path, backend):
+    # Carga el modelo con el backend indicado; si falla se usa PyTorch
+    if backend != "torch":
+        try:
+            return YOLO(export_model(model_path, backend), task="segment")
+        except Exception as e:
+            logging.warning(f"No se puede usar el backend {backend} ({e}), se usa PyTorch")
+    return YOLO(model_path)
+
+
+def get_model(model_path, backend=None):
+    """
+    Devuelve el modelo YOLO de model_path, cargándolo solo si no está en la caché.
+
+        Parámetros:
+            - model_path: Path al fichero de pesos (.pt).
+            - backend: "torch", "onnx" u "openvino" (por defecto settings.DL_BACKEND).
+
+        Retorno:
+            - Modelo YOLO listo para inferencia. Si el fichero cambia (mtime o tamaño)
+              se vuelve a cargar y la versión anterior se descarta.
+    """
+    backend = backend or settings.DL_BACKEND
+    key = _model_key(model_path) + (backend,)
+    with _lock:
+        if key in _models:
+            _models.move_to_end(key)
+            return _models[key][0]
+
+    with _load_lock:
+        with _lock:
+            if key in _models: # Cargado por otro hilo mientras se esperaba
+                return _models[key][0]
+        model = _load(model_path, backend)
+        with _lock:
+            # Versiones anteriores del mismo fichero ya no son válidas
+            for old_key in [k for k in _models if k[0] == key[0] and k[3] == backend]:
+                del _models[old_key]
+            _models[key] = (model, _model_size(model, model_path))
+            _evict(settings.DL_MODEL_CACHE_SIZE, settings.DL_MODEL_CACHE_MAX_MB * 1024 * 1024)
+        logging.info(f"Modelo {model_path} ({backend}) cargado en caché")
+        return model
+
+
+def model_version(model_path):
+    """
+    Versión de un modelo: primeros caracteres del SHA-256 del fichero de pesos.
+    El hash solo se calcula de nuevo si el fichero cambia.
+    """
+    key = _model_key(model_path)
+    if key not in _versions:
+        sha = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        _versions[key] = sha.hexdigest()[:16]
+    return _versions[key]
+
+
+def clear_models():
+    with _lock:
+        _models.clear()
+
+
+def warm_up(model_path=None):
+    """
+    Carga el modelo y ejecuta una inferencia sobre una imagen vacía para que
+    la primera petición no pague el coste de arranque.
+    """
+    model_path = model_path or settings.DL_MODEL_PATH
+    if not os.path.exists(model_path):
+        logging.warning(f"No se puede precargar el modelo: {model_path} no existe")
+        return None
+    model = get_model(model_path)
+    model(np.zeros((640, 640, 3), dtype=np.uint8), verbose=False)
+    return model
@@ -0,0 +1,158 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Registro de modelos: versiones de los pesos guardadas en MEDIA_ROOT/YOLO_models, modelo por
+defecto y modelo activo de cada proyecto. Los workers comprueban en segundo plano el modelo
+activo y cargan la nueva versión antes de dejar de usar la anterior.
+'''
+import os, time, shutil, logging, threading
+from django.conf import settings
+from django.db import transaction
+from DH_app.models import DL_model, Projects
+from DH_app.data.manifest import file_hash
+from DH_app.data.model_cache import get_model
+
+MODELS_DIR = "YOLO_models"
+
+# proyecto (None: modelo por defecto) -> path del modelo que usa este proceso
+_current = {}
+_watcher = None
+_lock = threading.Lock()
+
+
+def model_file(model):
+    return os.path.join(settings.MEDIA_ROOT, model.file)
+
+
+def register_model(path, name, description="", default=False):
+    """
+    Copia unos pesos al almacén de modelos y los registra. Si la versión (hash) ya
+    existe se devuelve el registro existente.
+
+        Retorno:
+            - Objeto DL_model.
+    """
+    checksum = file_hash(path)
+    version = checksum[:16]
+    model = DL_model.objects.filter(version=version).first()
+    if model is None:
+        rel = os.path.join(MODELS_DIR, f"{version}.pt")
+        dest = os.path.join(settings.MEDIA_ROOT, rel)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(path, dest + ".tmp")
+        if file_hash(dest + ".tmp") != checksum:
+            os.remove(dest + ".tmp")
+            raise IOError(f"Error al copiar el modelo {path}: el checksum no coincide.")
+        os.replace(dest + ".tmp", dest)
+        model = DL_model.objects.create(name=name, version=version, checksum=checksum, file=rel,
+                                        size=os.path.getsize(dest), description=description)
+    if default:
+        set_default(model)
+    return model
+
+
+def verify_model(model):
+    # True si el fichero de pesos existe y coincide con el checksum registrado
+    path = model_file(model)
+    return os.path.exists(path) and file_hash(path) == model.checksum
+
+
+def set_default(model):
+    with transaction.atomic():
+        DL_model.objects.exclude(ID=model.ID).update(is_default=False)
+        DL_model.objects.filter(ID=model.ID).update(is_default=True)
+
+
+def set_active(project, model):
+    # model None: el proyecto vuelve a usar el modelo por defecto
+    Projects.objects.filter(project_name=str(project)).update(active_model=model)
+
+
+def active_model(project=None):
+    """
+    Modelo activo de un proyecto (o el modelo por defecto).
+
+        Retorno:
+            - Objeto DL_model o None si el registro está vacío.
+    """
+    model = None
+    if project is not None:
+        model = DL_model.objects.filter(projects__project_name=str(project)).first()
+    return model or DL_model.objects.filter(is_default=True).first()
+
+
+def active_model_path(project=None):
+    # Sin modelos registrados se usa settings.DL_MODEL_PATH
+    model = active_model(project)
+    return model_file(model) if model else settings.DL_MODEL_PATH
+
+
+def refresh_models():
+    """
+    Carga los modelos activos que han cambiado y, una vez cargados, los pone en uso.
+    Mientras tanto los trabajos siguen usando la versión anterior. Solo se revisan los
+    proyectos que ya han usado este proceso: cargar los de todos los proyectos llenaría la
+    caché de modelos (DL_MODEL_CACHE_SIZE) y echaría los que están usando los trabajos.
+    """
+    for project in list(_current):
+        path = active_model_path(project)
+        if _current.get(project) == path or not os.path.exists(path):
+            continue
+        try:
+            get_model(path)
+        except Exception as e:
+            logging.error(f"No se puede cargar el modelo {path}: {e}")
+            continue
+        if project in _current:
+            logging.info(f"Proyecto {project or '(por defecto)'}: nuevo modelo {path}")
+        _current[project] = path
+
+
+def current_model_path(project=None):
+    """
+    Path del modelo que debe usar este proceso para un proyecto: el último cargado por el
+    hilo de refresh_models o, la primera vez, el modelo activo (se carga al usarlo).
+    """
+    project = str(project) if project is not None else None
+    if _watcher is None:
+        return active_model_path(project)
+    if project not in _current:
+        _current[project] = active_model_path(project)
+    return _current[project]
+
+
+def _watch(interval):
+    while True:
+        try:
+            refresh_models()
+        except Exception as e:
+            logging.error(f"Error al comprobar los modelos activos: {e}")
+        time.sleep(interval)
+
+
+def start_watcher(interval=None):
+    # Un hilo por proceso que comprueba cada settings.DL_MODEL_POLL segundos el modelo activo
+    global _watcher
+    with _lock:
+        if _watcher is None:
+            _watcher = threading.Thread(target=_watch, args=(interval or settings.DL_MODEL_POLL,),
+                                        name="DL_model_watcher", daemon=True)
+            _watcher.start()
+    return _watcher
@@ -0,0 +1,186 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Imágenes procesadas bajo demanda: las detecciones se dibujan a partir de las máscaras
+guardadas (mask_store) con los filtros de clase y confianza de cada petición, y el resultado
+se guarda en una caché en disco de tamaño limitado (se borran las menos usadas)
+'''
+import os, time, hashlib, logging, threading
+from urllib.parse import urlencode
+import numpy as np
+import cv2 as cv
+from django.conf import settings
+from django.urls import reverse
+from DH_app.data.mask_store import mask_paths, read_masks
+from DH_app.data.process_images import CLASS_COLORS
+from DH_app.data.thumbnails import DERIVATIVES, _read_reduced, image_entry, image_size
+from DH_app.data.preprocess import inference_input
+
+SCAN_INTERVAL = 60 # Segundos entre recuentos completos de la caché (la comparten varios procesos)
+_cache_lock = threading.Lock()
+_cache_bytes = None # Tamaño estimado de la caché: último recuento más lo escrito desde entonces
+_last_scan = 0
+
+
+def render_overlay(image_path, labels=None, min_conf=0, max_side=None, alpha=0.4):
+    """
+    Dibuja las máscaras, cajas y etiquetas guardadas de una imagen (sobre la imagen
+    preprocesada si existe, que es sobre la que se hizo la inferencia).
+
+        Parámetros:
+            - labels: Clases a dibujar (None: todas).
+            - min_conf: Confianza mínima.
+            - max_side: Lado máximo de la imagen resultante (None: tamaño original).
+
+        Retorno:
+            - Imagen BGR o None si no se puede leer.
+    """
+    source = inference_input(image_path)
+    try:
+        width, height = image_size(source)
+    except Exception: # No es una imagen
+        return None
+    scale = min(max_side / max(width, height), 1) if max_side else 1
+    img = _read_reduced(source, max_side) if max_side else cv.imread(source)
+    if img is None:
+        return None
+    size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    if (img.shape[1], img.shape[0]) != size:
+        img = cv.resize(img, size, interpolation=cv.INTER_AREA)
+
+    masks = read_masks(image_path, labels=labels, min_conf=min_conf)
+    overlay = img.copy()
+    for e, mask in masks:
+        x, y = round(e["x"] * scale), round(e["y"] * scale)
+        w, h = max(round(e["width"] * scale), 1), max(round(e["height"] * scale), 1)
+        mask = cv.resize(mask.astype(np.uint8), (w, h), interpolation=cv.INTER_NEAREST).astype(bool)
+        w, h = min(w, size[0] - x), min(h, size[1] - y)
+        if w > 0 and h > 0:
+            overlay[y:y + h, x:x + w][mask[:h, :w]] = CLASS_COLORS[e["cls"] % len(CLASS_COLORS)]
+    plotted = cv.addWeighted(overlay, alpha, img, 1 - alpha, 0)
+
+    thickness = max(round(2 * scale), 1)
+    for e, _ in masks:
+        color = CLASS_COLORS[e["cls"] % len(CLASS_COLORS)]
+        x1, y1 = round(e["x"] * scale), round(e["y"] * scale)
+        x2, y2 = round((e["x"] + e["width"]) * scale), round((e["y"] + e["height"]) * scale)
+        cv.rectangle(plotted, (x1, y1), (x2, y2), color, thickness)
+        cv.putText(plotted, f"{e['label']} {e['conf']:.2f}", (x1, max(y1 - 5, 15)),
+                   cv.FONT_HERSHEY_SIMPLEX, max(0.6 * scale, 0.35), color, thickness)
+    return plotted
+
+
+def _cache_key(image_path, labels, min_conf, max_side):
+    # La clave cambia si se modifica la imagen o se vuelve a procesar (índice de máscaras)
+    _, index_path = mask_paths(image_path)
+    stamps = [os.stat(p).st_mtime_ns if os.path.exists(p) else 0 for p in (inference_input(image_path), index_path)]
+    key = f"{os.path.abspath(image_path)}|{stamps}|{sorted(labels) if labels else ''}|{min_conf}|{max_side}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _evict(max_bytes, keep=None):
+    # Borra las entradas usadas hace más tiempo (salvo keep) hasta quedar por debajo del límite.
+    # Recorre toda la carpeta: se llama desde _track solo cuando hace falta
+    entries = []
+    with os.scandir(settings.OVERLAY_CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file() and entry.path != keep:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries) + (os.path.getsize(keep) if keep else 0)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError: # Borrada por otro proceso
+            pass
+        total -= size
+    return total
+
+
+def _track(path, max_bytes):
+    """
+    Suma una entrada nueva al tamaño estimado de la caché. La carpeta solo se recorre al
+    superar el límite (y entonces se libera hasta el 90 % para no repetirlo en cada escritura)
+    o cada SCAN_INTERVAL segundos, para contar lo escrito por otros procesos.
+    """
+    global _cache_bytes, _last_scan
+    with _cache_lock:
+        now = time.monotonic()
+        if _cache_bytes is not None:
+            _cache_bytes += os.path.getsize(path)
+            if _cache_bytes <= max_bytes and now - _last_scan < SCAN_INTERVAL:
+                return
+        target = max_bytes * 0.9 if _cache_bytes is not None and _cache_bytes > max_bytes else max_bytes
+        _cache_bytes = _evict(target, keep=path)
+        _last_scan = now
+
+
+def overlay_path(image_path, labels=None, min_conf=0, max_side=None):
+    """
+    Path de la imagen procesada en la caché, dibujándola si no está.
+
+        Retorno:
+            - Path del fichero JPEG o None si la imagen no se puede leer.
+    """
+    os.makedirs(settings.OVERLAY_CACHE_DIR, exist_ok=True)
+    path = os.path.join(settings.OVERLAY_CACHE_DIR, _cache_key(image_path, labels, min_conf, max_side) + ".jpg")
+    if os.path.exists(path):
+        os.utime(path) # Marca de último uso para la política LRU
+        return path
+    plotted = render_overlay(image_path, labels, min_conf, max_side)
+    if plotted is None:
+        logging.warning(f"No se puede leer la imagen {image_path}")
+        return None
+    tmp = f"{path[:-4]}.{os.getpid()}.tmp.jpg"
+    cv.imwrite(tmp, plotted, [cv.IMWRITE_JPEG_QUALITY, 85])
+    os.replace(tmp, path)
+    _track(path, settings.OVERLAY_CACHE_MAX_MB * 1024 * 1024)
+    return path
+
+
+def processed_entry(image, labels=None, min_conf=0, processed=True):
+    """
+    Equivalente a image_entry para la imagen procesada de una imagen original (path relativo
+    a MEDIA_ROOT). Si hay máscaras guardadas las versiones apuntan a la vista show_overlay;
+    si no, se usa la imagen processed_ generada al procesar (si existe).
+    processed: estado de la imagen en la BD; si no se ha procesado no se busca en disco.
+    """
+    if not processed:
+        return None
+    full_path = os.path.join(settings.MEDIA_ROOT, image)
+    if os.path.exists(mask_paths(full_path)[1]):
+        query = {"image": image}
+        if labels:
+            query["labels"] = ",".join(labels)
+        if min_conf:
+            query["conf"] = min_conf
+        url = reverse("show_overlay") + "?" + urlencode(query)
+        entry = {"full": url}
+        for kind, (max_side, _, _) in DERIVATIVES.items():
+            entry[kind] = f"{url}&size={kind}"
+            entry[f"{kind}_size"] = max_side
+        return entry
+    folder, name = os.path.split(image)
+    processed = os.path.join(os.path.dirname(folder), "processed_imgs", f"processed_{name}")
+    if os.path.exists(os.path.join(settings.MEDIA_ROOT, processed)):
+        return image_entry(processed)
+    return None
@@ -0,0 +1,215 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Preprocesado de las fotos de las cajas de testigo: detección de la caja, corrección del giro,
+recorte y normalización de la iluminación. El resultado se guarda en <sondeo>/preprocessed
+y es la imagen que se usa para la inferencia y para dibujar las detecciones. Junto a ella se
+guarda la transformación desde la foto original (<nombre>.json) para poder llevar las
+detecciones a las coordenadas de la foto.
+'''
+import os, json, logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2 as cv
+from django.conf import settings
+from DH_app.data.thumbnails import image_size
+
+DETECT_SIDE = 1024 # Lado máximo de la imagen reducida en la que se busca la caja
+
+
+def preprocessed_path(path):
+    # <sondeo>/images/S001_1.jpg -> <sondeo>/preprocessed/S001_1.jpg
+    folder, name = os.path.split(path)
+    return os.path.join(os.path.dirname(folder), "preprocessed", os.path.splitext(name)[0] + ".jpg")
+
+
+def transform_path(path):
+    # Transformación (matriz 3x3 original -> preprocesada), tamaño y lado máximo de la preprocesada
+    return os.path.splitext(preprocessed_path(path))[0] + ".json"
+
+
+def detect_box(img, min_area=None):
+    """
+    Busca la caja de testigo: mayor contorno de la imagen umbralizada (Otsu) y cerrada.
+
+        Retorno:
+            - Array 4x2 con las esquinas de la caja (coordenadas de img) o None si no se
+              encuentra una caja que ocupe al menos min_area de la imagen.
+    """
+    min_area = settings.PREPROCESS_MIN_AREA if min_area is None else min_area
+    scale = min(DETECT_SIDE / max(img.shape[:2]), 1)
+    small = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA) if scale < 1 else img
+    gray = cv.GaussianBlur(cv.cvtColor(small, cv.COLOR_BGR2GRAY), (5, 5), 0)
+    _, mask = cv.threshold(gray, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    # La caja puede ser más clara u oscura que el fondo: se toma como fondo el valor del borde
+    border = np.concatenate([mask[0], mask[-1], mask[:, 0], mask[:, -1]])
+    if border.mean() > 127:
+        mask = cv.bitwise_not(mask)
+    kernel = cv.getStructuringElement(cv.MORPH_RECT, (15, 15))
+    mask = cv.morphologyEx(mask, cv.MORPH_CLOSE, kernel)
+    contours, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    contour = max(contours, key=cv.contourArea)
+    rect = cv.minAreaRect(contour)
+    if rect[1][0] * rect[1][1] < min_area * small.shape[0] * small.shape[1]:
+        return None
+    return cv.boxPoints(rect) / scale
+
+
+def order_corners(corners):
+    # Esquinas en orden: superior izquierda, superior derecha, inferior derecha, inferior izquierda
+    s, d = corners.sum(axis=1), np.diff(corners, axis=1).ravel()
+    return np.array([corners[s.argmin()], corners[d.argmin()], corners[s.argmax()], corners[d.argmax()]], dtype=np.float32)
+
+
+def deskew_crop(img, corners):
+    """
+    Endereza y recorta la caja en una sola transformación de perspectiva.
+    La caja se deja apaisada (filas de testigo horizontales).
+
+        Retorno:
+            - Tupla (imagen recortada, matriz 3x3 de coordenadas de img a las del recorte).
+    """
+    tl, tr, br, bl = order_corners(corners)
+    width = int(round(max(np.linalg.norm(tr - tl), np.linalg.norm(br - bl))))
+    height = int(round(max(np.linalg.norm(bl - tl), np.linalg.norm(br - tr))))
+    dst = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv.getPerspectiveTransform(np.array([tl, tr, br, bl]), dst)
+    out = cv.warpPerspective(img, matrix, (width, height), flags=cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE)
+    if height > width:
+        # Giro de 90º en sentido horario: (x, y) -> (height - 1 - y, x)
+        matrix = np.array([[0, -1, height - 1], [1, 0, 0], [0, 0, 1]], dtype=float) @ matrix
+        out = cv.rotate(out, cv.ROTATE_90_CLOCKWISE)
+    return out, matrix
+
+
+def normalize_illumination(img, clip_limit=None):
+    # CLAHE sobre la luminancia (canal L de Lab) para igualar la iluminación sin alterar el color
+    clip_limit = clip_limit or settings.PREPROCESS_CLAHE_CLIP
+    lab = cv.cvtColor(img, cv.COLOR_BGR2LAB)
+    clahe = cv.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8))
+    lab[:, :, 0] = clahe.apply(lab[:, :, 0])
+    return cv.cvtColor(lab, cv.COLOR_LAB2BGR)
+
+
+def preprocess(img, max_side=None):
+    """
+    Caja detectada, enderezada y recortada, reducida a max_side (0: sin reducir) y con la
+    iluminación normalizada. Si no se encuentra la caja se usa la imagen completa.
+
+        Retorno:
+            - Tupla (imagen preprocesada, matriz 3x3 de coordenadas de img a las de la preprocesada).
+    """
+    max_side = settings.PREPROCESS_MAX_SIDE if max_side is None else max_side
+    matrix = np.eye(3)
+    corners = detect_box(img)
+    if corners is not None:
+        img, matrix = deskew_crop(img, corners)
+    scale = max_side / max(img.shape[:2]) if max_side else 1
+    if scale < 1:
+        img = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+        matrix = np.diag([scale, scale, 1]) @ matrix
+    return normalize_illumination(img), matrix
+
+
+def target_side(tiled=None):
+    # En la inferencia por teselas la imagen no se reduce: las teselas son para mantener la resolución
+    tiled = settings.DL_INFERENCE_MODE == "tiled" if tiled is None else tiled
+    return 0 if tiled else settings.PREPROCESS_MAX_SIDE
+
+
+def read_transform(path):
+    # Datos guardados por preprocess_image o None si no existen
+    try:
+        with open(transform_path(path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def preprocess_image(path, max_side=None):
+    """
+    Genera la imagen preprocesada si no existe, es anterior a la original o se generó con otro
+    lado máximo. Se guarda también la transformación desde la original (transform_path).
+
+        Retorno:
+            - Path de la imagen preprocesada o None si la original no se puede leer.
+    """
+    max_side = target_side() if max_side is None else max_side
+    out = preprocessed_path(path)
+    if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(path):
+        saved = read_transform(path)
+        if saved and saved["max_side"] == max_side:
+            return out
+    img = cv.imread(path)
+    if img is None:
+        logging.warning(f"No se puede leer la imagen {path}")
+        return None
+    processed, matrix = preprocess(img, max_side)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    tmp = f"{out[:-4]}.{os.getpid()}.tmp.jpg"
+    cv.imwrite(tmp, processed, [cv.IMWRITE_JPEG_QUALITY, 95])
+    with open(f"{tmp}.json", "w") as f:
+        json.dump({"matrix": matrix.tolist(), "width": processed.shape[1], "height": processed.shape[0], "max_side": max_side}, f)
+    os.replace(f"{tmp}.json", transform_path(path))
+    os.replace(tmp, out)
+    return out
+
+
+def preprocess_images(paths, tiled=None):
+    # OpenCV libera el GIL en las operaciones sobre la imagen, así que los hilos trabajan en paralelo
+    if not settings.PREPROCESS_IMAGES:
+        return
+    max_side = target_side(tiled)
+    with ThreadPoolExecutor(max_workers=settings.PREPROCESS_WORKERS) as executor:
+        list(executor.map(lambda path: preprocess_image(path, max_side), paths))
+
+
+def inference_input(path):
+    # Imagen que se usa para la inferencia y para dibujar las detecciones
+    if settings.PREPROCESS_IMAGES:
+        out = preprocessed_path(path)
+        if os.path.exists(out):
+            return out
+    return path
+
+
+def input_transform(path):
+    """
+    Transformación de la foto original a la imagen de inferencia (inference_input).
+
+        Retorno:
+            - Tupla (matriz 3x3, (ancho, alto) de la imagen de inferencia) o None si no se sabe
+              (imagen preprocesada por una versión anterior).
+    """
+    source = inference_input(path)
+    if source == path:
+        return np.eye(3), image_size(path)
+    saved = read_transform(path)
+    if saved is None:
+        return None
+    return np.array(saved["matrix"]), (saved["width"], saved["height"])
+
+
+def to_original(points, matrix):
+    # Puntos (Nx2) de la imagen de inferencia a coordenadas de la foto original
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+    return cv.perspectiveTransform(points, np.linalg.inv(matrix)).reshape(-1, 2)
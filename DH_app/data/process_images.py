@@ -23,34 +23,333 @@ Funciones para el procesado de las imágenes por el modelo de Deep Learning
 import torch, os
 import ultralytics
 import cv2 as cv
+import numpy as np
 from ultralytics import YOLO
 import logging
+from django.conf import settings
+from DH_app.data.model_cache import get_model, model_version
+from DH_app.data.detections import save_detections
+from DH_app.data.manifest import sync_manifest, pending_images, mark_processed, image_path, file_hash
+from DH_app.data.thumbnails import generate_derivatives
+from DH_app.data.fracture_log import update_fracture_log
+from DH_app.data.rqd import update_rqd
+from DH_app.data.inference_server import get_server
+from DH_app.data.result_cache import perceptual_hash, lookup, store, from_cache
+from DH_app.data.mask_store import write_masks
+from DH_app.data.preprocess import preprocess_images, inference_input
+from DH_app.data.file_manager import media_path
+from DH_app.models import Images
 
-def process_imgs(folder_path, model_path):
+'''
+Divide una lista en lotes de tamaño batch_size
+'''
+def batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+'''
+----------------------------------------------------
+            DETECCIONES
+----------------------------------------------------
+'''
+# Colores (BGR) para las clases del modelo
+CLASS_COLORS = [(56, 56, 255), (151, 157, 255), (31, 112, 255), (29, 178, 255), (49, 210, 207)]
+
+def result_detections(result, offset=(0, 0)):
+    """
+    Convierte un resultado de ultralytics en una lista de detecciones.
+
+        Parámetros:
+            - result: Objeto Results devuelto por el modelo.
+            - offset: Desplazamiento (x, y) que se suma a las coordenadas (teselas).
+
+        Retorno:
+            - Lista de diccionarios con las claves cls, label, conf, box (x1, y1, x2, y2)
+              y polygons (lista de arrays Nx2 con el contorno de la máscara).
+    """
+    if result.boxes is None or not len(result.boxes):
+        return []
+    dx, dy = offset
+    xyxy = result.boxes.xyxy.cpu().numpy() + np.array([dx, dy, dx, dy])
+    conf = result.boxes.conf.cpu().numpy()
+    cls = result.boxes.cls.cpu().numpy().astype(int)
+    polygons = result.masks.xy if result.masks is not None else [None] * len(xyxy)
+    detections = []
+    for box, c, k, polygon in zip(xyxy, conf, cls, polygons):
+        detections.append({
+            "cls": int(k),
+            "label": result.names[int(k)],
+            "conf": float(c),
+            "box": box.astype(float),
+            "polygons": [polygon + np.array([dx, dy])] if polygon is not None and len(polygon) else [],
+        })
+    return detections
+
+def box_iou(box, boxes):
+    # IoU entre una caja (x1, y1, x2, y2) y un array de cajas Nx4
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / np.maximum((box[2] - box[0]) * (box[3] - box[1]) + areas - inter, 1e-6)
+
+def match_detections(reference, detections, iou=0.5):
+    """
+    Empareja detecciones de la misma clase por IoU (de mayor a menor confianza).
+
+        Retorno:
+            - Lista de pares (índice en reference, índice en detections).
+    """
+    pairs = []
+    used = np.zeros(len(detections), dtype=bool)
+    boxes = np.array([d["box"] for d in detections], dtype=float).reshape(-1, 4)
+    cls = np.array([d["cls"] for d in detections])
+    for i in np.argsort([-d["conf"] for d in reference]):
+        if not len(boxes):
+            break
+        scores = np.where(used | (cls != reference[i]["cls"]), 0, box_iou(reference[i]["box"], boxes))
+        best = scores.argmax()
+        if scores[best] >= iou:
+            used[best] = True
+            pairs.append((int(i), int(best)))
+    return pairs
+
+def draw_detections(img, detections, alpha=0.4):
+    """
+    Dibuja las máscaras, cajas y etiquetas de las detecciones sobre una copia de la imagen.
+    """
+    overlay = img.copy()
+    for det in detections:
+        color = CLASS_COLORS[det["cls"] % len(CLASS_COLORS)]
+        polygons = [p.astype(np.int32) for p in det["polygons"] if len(p)]
+        if polygons:
+            cv.fillPoly(overlay, polygons, color)
+    plotted = cv.addWeighted(overlay, alpha, img, 1 - alpha, 0)
+    for det in detections:
+        color = CLASS_COLORS[det["cls"] % len(CLASS_COLORS)]
+        x1, y1, x2, y2 = [int(v) for v in det["box"]]
+        cv.rectangle(plotted, (x1, y1), (x2, y2), color, 2)
+        cv.putText(plotted, f"{det['label']} {det['conf']:.2f}", (x1, max(y1 - 5, 15)),
+                   cv.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+    return plotted
+
+'''
+----------------------------------------------------
+            INFERENCIA POR TESELAS
+----------------------------------------------------
+'''
+def check_tiling(tile_size, overlap):
+    # Con overlap >= tile_size el paso entre teselas sería nulo o negativo
+    if tile_size <= 0 or not 0 <= overlap < tile_size:
+        raise ValueError(f"Configuración de teselas no válida: tamaño {tile_size}, solape {overlap} (debe ser 0 <= solape < tamaño)")
+
+def tile_offsets(length, tile_size, overlap):
+    # Posiciones de inicio de las teselas en un eje; la última se ajusta al borde de la imagen
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    offsets = list(range(0, length - tile_size, step))
+    offsets.append(length - tile_size)
+    return offsets
+
+def tile_image(img, tile_size, overlap):
+    """
+    Divide una imagen en teselas solapadas.
+
+        Retorno:
+            - Lista de tuplas (tesela, (x, y)) con la posición de cada tesela en la imagen.
+    """
+    height, width = img.shape[:2]
+    return [(img[y:y + tile_size, x:x + tile_size], (x, y))
+            for y in tile_offsets(height, tile_size, overlap)
+            for x in tile_offsets(width, tile_size, overlap)]
+
+def merge_detections(detections, iou=0.5, edges=None):
+    """
+    Une las detecciones de teselas solapadas.
+
+    Dos detecciones de la misma clase se unen si la intersección respecto a la menor de
+    las cajas supera iou (duplicados en el solape, equivalente a NMS) o si se tocan y alguna
+    llega al borde interior de su tesela (objeto cortado por la tesela). La detección resultante
+    toma la caja envolvente, la mayor confianza y la unión de los contornos de las máscaras.
+
+        Parámetros:
+            - detections: Lista de detecciones (ver result_detections).
+            - iou: Umbral de solape para considerar dos detecciones la misma.
+            - edges: Lista de booleanos que indica si cada detección toca un borde interior de tesela.
+    """
+    if not detections:
+        return []
+    order = np.argsort([-d["conf"] for d in detections])
+    detections = [detections[i] for i in order]
+    boxes = np.array([d["box"] for d in detections], dtype=float)
+    cls = np.array([d["cls"] for d in detections])
+    edges = np.zeros(len(detections), dtype=bool) if edges is None else np.asarray(edges, dtype=bool)[order]
+    alive = np.ones(len(detections), dtype=bool)
+    merged = []
+
+    for i in range(len(detections)):
+        if not alive[i]:
+            continue
+        alive[i] = False
+        det = dict(detections[i], polygons=list(detections[i]["polygons"]))
+        box, edge = boxes[i].copy(), edges[i]
+        while True:
+            x1 = np.maximum(box[0], boxes[:, 0])
+            y1 = np.maximum(box[1], boxes[:, 1])
+            x2 = np.minimum(box[2], boxes[:, 2])
+            y2 = np.minimum(box[3], boxes[:, 3])
+            inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+            touching = (x2 >= x1) & (y2 >= y1)
+            areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            smaller = np.minimum(areas, (box[2] - box[0]) * (box[3] - box[1]))
+            overlap = inter / np.maximum(smaller, 1e-6)
+            same = alive & (cls == det["cls"]) & ((overlap >= iou) | (touching & (edges | edge)))
+            if not same.any():
+                break
+            for j in np.flatnonzero(same):
+                det["polygons"].extend(detections[j]["polygons"])
+            box = np.concatenate([np.minimum(box[:2], boxes[same, :2].min(axis=0)),
+                                  np.maximum(box[2:], boxes[same, 2:].max(axis=0))])
+            edge = edge or edges[same].any()
+            alive[same] = False
+        det["box"] = box
+        merged.append(det)
+    return merged
+
+def predict_tiled(model, img, tile_size=None, overlap=None, batch_size=None, iou=None):
+    """
+    Inferencia por teselas de una imagen completa (array BGR).
+
+        Retorno:
+            - Lista de detecciones en coordenadas de la imagen original.
+    """
+    tile_size = tile_size or settings.DL_TILE_SIZE
+    overlap = settings.DL_TILE_OVERLAP if overlap is None else overlap
+    batch_size = batch_size or settings.DL_BATCH_SIZE
+    iou = iou or settings.DL_TILE_MERGE_IOU
+    check_tiling(tile_size, overlap)
+    height, width = img.shape[:2]
+    detections, edges = [], []
+
+    for batch in batches(tile_image(img, tile_size, overlap), batch_size):
+        tiles = [np.ascontiguousarray(tile) for tile, _ in batch]
+        for (tile, (x, y)), result in zip(batch, model(tiles, stream=True, verbose=False)):
+            for det in result_detections(result, offset=(x, y)):
+                x1, y1, x2, y2 = det["box"]
+                # Bordes de la tesela que no coinciden con el borde de la imagen
+                edges.append((x > 0 and x1 <= x + 2) or (y > 0 and y1 <= y + 2) or
+                             (x + tile.shape[1] < width and x2 >= x + tile.shape[1] - 2) or
+                             (y + tile.shape[0] < height and y2 >= y + tile.shape[0] - 2))
+                detections.append(det)
+    return merge_detections(detections, iou, edges)
+
+'''
+----------------------------------------------------
+            PROCESADO DE IMÁGENES
+----------------------------------------------------
+'''
+def process_imgs(folder_path, model_path, progress=None, batch_size=None, mode=None, DH=None):
     # ultralytics.checks()
+    # progress: función opcional progress(procesadas, total) llamada tras cada imagen
+    # batch_size: imágenes (o teselas) por lote (por defecto settings.DL_BATCH_SIZE)
+    # mode: "full" (imagen completa) o "tiled" (teselas), por defecto settings.DL_INFERENCE_MODE
+    # DH: sondeo (General_DH); si se indica, se procesan las imágenes pendientes según el
+    #     manifiesto y las detecciones se guardan en la BD
     images_path = os.path.join(folder_path, "images")
     p_images_path = os.path.join(folder_path, "processed_imgs")
+    version = model_version(model_path)
     imgs = []
     imgs_name =[]
-    processed_imgs = [img for img in os.listdir(p_images_path)]
-    for img in os.listdir(images_path):
-        if img not in processed_imgs:
-            imgs.append(os.path.join(images_path,img))
-            imgs_name.append(os.path.split(img)[-1])
-    model = YOLO(model_path)
-    results = model(imgs)
-
-    for img, result in zip(imgs_name,results):
-        res_plotted = result.plot()
-        res_plotted = cv.imwrite(f"{p_images_path}/processed_{img}", res_plotted) # Linux
-        #res_plotted = cv.imwrite(f"{p_images_path}\processed_{img}", res_plotted) # Windows
-'''
-Listar imágenes de una carpeta
-'''
-def list_images(folder):
-    images = []
-    for image in os.listdir(folder):
-        img_path =os.path.join(folder, image).split("/Deep-Core/media/")[-1] # Linux
-        #img_path =os.path.join(folder, image).split("\media")[-1] # Windows
-        images.append(img_path)
-    return images
\ No newline at end of file
+    if DH is not None:
+        # Solo las imágenes nuevas, modificadas o procesadas con otro modelo (manifiesto)
+        sync_manifest(DH, images_path)
+        imgs = [image_path(image) for image in pending_images(DH, version)]
+        imgs_name = [os.path.basename(img) for img in imgs]
+    else:
+        processed_imgs = [img for img in os.listdir(p_images_path)]
+        for img in os.listdir(images_path):
+            if f"processed_{img}" not in processed_imgs:
+                imgs.append(os.path.join(images_path,img))
+                imgs_name.append(os.path.split(img)[-1])
+    if progress:
+        progress(0, len(imgs))
+    if not imgs:
+        return
+    # Con DL_DYNAMIC_BATCHING las imágenes de varios trabajos del mismo proceso se agrupan
+    # en micro-lotes y se ejecutan en un único hilo con el modelo compartido
+    model = get_server(model_path) if settings.DL_DYNAMIC_BATCHING else get_model(model_path)
+    batch_size = batch_size or settings.DL_BATCH_SIZE
+    mode = mode or settings.DL_INFERENCE_MODE
+    if mode == "tiled": # Antes de procesar ninguna imagen
+        check_tiling(settings.DL_TILE_SIZE, settings.DL_TILE_OVERLAP)
+    # Sin DL_EAGER_OVERLAYS no se escriben las imágenes processed_: se dibujan bajo demanda
+    # a partir de las máscaras (DH_app.data.overlays). Sin sondeo se siguen escribiendo porque
+    # son las que indican qué imágenes están procesadas.
+    eager = settings.DL_EAGER_OVERLAYS or DH is None
+
+    count = 0
+    for batch, batch_names in zip(batches(imgs, batch_size), batches(imgs_name, batch_size)):
+        detections = {}
+        hashes = {}
+        # La inferencia se hace sobre la caja recortada y normalizada (si está activado el preprocesado)
+        preprocess_images(batch, tiled=mode == "tiled")
+        sources = {path: inference_input(path) for path in batch}
+        if DH is not None and settings.DL_RESULT_CACHE:
+            # Imágenes ya procesadas (o casi idénticas en el mismo sondeo): se reutilizan sus detecciones
+            rows = {name: (content_hash, phash) for name, content_hash, phash in Images.objects.filter(
+                DH_id=DH, Images__in=[media_path(p) for p in batch]).values_list("Images", "content_hash", "phash")}
+            for path in batch:
+                content_hash, phash = rows.get(media_path(path), ("", ""))
+                hashes[path] = (content_hash or file_hash(path), phash or perceptual_hash(path))
+            for path, img in zip(batch, batch_names):
+                cached = lookup(DH, hashes[path], version)
+                if cached is None:
+                    continue
+                image = cv.imread(sources[path])
+                detections[path] = from_cache(cached, image.shape[1], image.shape[0])
+                if eager:
+                    cv.imwrite(f"{p_images_path}/processed_{img}", draw_detections(image, detections[path]))
+                count += 1
+                if progress:
+                    progress(count, len(imgs))
+        to_infer = [path for path in batch if path not in detections]
+        to_infer_names = [img for path, img in zip(batch, batch_names) if path not in detections]
+
+        if to_infer and mode == "tiled":
+            # Cada imagen se divide en teselas que se procesan por lotes
+            for path, img in zip(to_infer, to_infer_names):
+                image = cv.imread(sources[path])
+                detections[path] = predict_tiled(model, image, batch_size=batch_size)
+                if path in hashes:
+                    store(DH, hashes[path], version, detections[path], image.shape[1], image.shape[0])
+                if eager:
+                    cv.imwrite(f"{p_images_path}/processed_{img}", draw_detections(image, detections[path]))
+                count += 1
+                if progress:
+                    progress(count, len(imgs))
+        elif to_infer:
+            # Cada resultado se guarda en cuanto sale del modelo, así la memoria
+            # no crece con el número de imágenes del sondeo.
+            for path, img, result in zip(to_infer, to_infer_names, model([sources[path] for path in to_infer], stream=True, verbose=False)):
+                detections[path] = result_detections(result)
+                if path in hashes:
+                    store(DH, hashes[path], version, detections[path], result.orig_shape[1], result.orig_shape[0])
+                if eager:
+                    res_plotted = result.plot()
+                    res_plotted = cv.imwrite(f"{p_images_path}/processed_{img}", res_plotted) # Linux
+                    #res_plotted = cv.imwrite(f"{p_images_path}\processed_{img}", res_plotted) # Windows
+                count += 1
+                if progress:
+                    progress(count, len(imgs))
+        generate_derivatives(batch + ([f"{p_images_path}/processed_{img}" for img in batch_names] if eager else []))
+        if settings.DL_STORE_MASKS or not eager:
+            for path, dets in detections.items():
+                write_masks(path, dets, version)
+        if DH is not None:
+            save_detections(DH, detections, version)
+            mark_processed(DH, detections.keys(), version)
+            update_fracture_log(DH, detections.keys())
+            update_rqd(DH, detections.keys())
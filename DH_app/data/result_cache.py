@@ -0,0 +1,115 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Caché de resultados del modelo: las imágenes repetidas (mismo SHA-256) reutilizan las detecciones
+sin ejecutar el modelo. Con DL_PHASH_DISTANCE > 0 también las casi idénticas por hash perceptual
+(recodificadas o redimensionadas), pero solo dentro del mismo sondeo: las fotos de cajas distintas
+(misma bandeja, mismo encuadre) pueden tener hashes perceptuales muy próximos.
+'''
+import json
+import numpy as np
+import cv2 as cv
+from django.conf import settings
+from django.db.models import Q
+from DH_app.models import Results_cache
+
+BANDS = 4 # El hash de 64 bits se divide en 4 bandas de 16 bits para buscar candidatos
+
+
+def perceptual_hash(path):
+    """
+    Hash perceptual (pHash) de 64 bits: signo de las frecuencias bajas de la DCT de la imagen
+    reducida a 32x32 en escala de grises respecto a su mediana.
+
+        Retorno:
+            - Hash en hexadecimal (16 caracteres) o "" si la imagen no se puede leer.
+    """
+    img = cv.imread(path, cv.IMREAD_REDUCED_GRAYSCALE_8)
+    if img is None:
+        return ""
+    small = cv.resize(img, (32, 32), interpolation=cv.INTER_AREA).astype(np.float32)
+    low = cv.dct(small)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return f"{int(''.join('1' if b else '0' for b in bits), 2):016x}"
+
+
+def hash_bands(phash):
+    value = int(phash, 16)
+    return [(value >> (16 * i)) & 0xFFFF for i in range(BANDS)]
+
+
+def hamming(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def to_cache(detections, width, height):
+    # Coordenadas normalizadas para que valgan para la misma imagen a otra resolución
+    scale = np.array([width, height], dtype=float)
+    return [{"cls": d["cls"], "label": d["label"], "conf": d["conf"],
+             "box": (np.asarray(d["box"]).reshape(2, 2) / scale).flatten().round(5).tolist(),
+             "polygons": [(p / scale).round(5).tolist() for p in d["polygons"]]} for d in detections]
+
+
+def from_cache(data, width, height):
+    scale = np.array([width, height], dtype=float)
+    return [{"cls": d["cls"], "label": d["label"], "conf": d["conf"],
+             "box": (np.array(d["box"]).reshape(2, 2) * scale).flatten(),
+             "polygons": [np.array(p).reshape(-1, 2) * scale for p in d["polygons"]]} for d in data]
+
+
+def lookup(DH, hashes, model_version):
+    """
+    Busca detecciones guardadas con el mismo modelo de la misma imagen (mismo SHA-256, de
+    cualquier sondeo) o, si settings.DL_PHASH_DISTANCE > 0, de una imagen casi idéntica del
+    mismo sondeo (distancia de Hamming menor o igual que DL_PHASH_DISTANCE).
+
+        Parámetros:
+            - hashes: Tupla (SHA-256, hash perceptual) de la imagen.
+
+        Retorno:
+            - Lista de detecciones normalizadas o None.
+    """
+    content_hash, phash = hashes
+    if content_hash:
+        entry = Results_cache.objects.filter(content_hash=content_hash, model_version=model_version).first()
+        if entry:
+            return json.loads(entry.detections)
+    if not phash or settings.DL_PHASH_DISTANCE <= 0:
+        return None
+    bands = hash_bands(phash)
+    query = Q()
+    for i, band in enumerate(bands):
+        query |= Q(**{f"band_{i}": band})
+    best = None
+    for entry in Results_cache.objects.filter(query, DH_id=DH, model_version=model_version):
+        distance = hamming(phash, entry.phash)
+        if distance <= settings.DL_PHASH_DISTANCE and (best is None or distance < best[0]):
+            best = (distance, entry)
+    return json.loads(best[1].detections) if best else None
+
+
+def store(DH, hashes, model_version, detections, width, height):
+    content_hash, phash = hashes
+    if not content_hash or not phash:
+        return
+    bands = dict(zip([f"band_{i}" for i in range(BANDS)], hash_bands(phash)))
+    Results_cache.objects.update_or_create(
+        DH_id=DH, content_hash=content_hash, model_version=model_version,
+        defaults=dict(bands, phash=phash, detections=json.dumps(to_cache(detections, width, height))))
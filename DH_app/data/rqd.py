@@ -0,0 +1,122 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+RQD (Rock Quality Designation) y recuperación por tramo a partir de las máscaras de testigo
+guardadas (mask_store), sin volver a ejecutar el modelo
+'''
+import os
+import numpy as np
+import cv2 as cv
+from django.conf import settings
+from django.db import transaction
+from DH_app.models import RQD_DH
+from DH_app.data.fracture_log import CORE, MARKER, vertical_overlap, core_axis, union, binned_length, affected_window
+from DH_app.data.manifest import image_path
+from DH_app.data.mask_store import read_masks, mask_paths
+
+MIN_PIECE_HEIGHT = 0.3 # Altura mínima de un trozo respecto a la fila de testigo (descarta fragmentos sueltos)
+
+
+def row_pieces(mask, markers):
+    """
+    Trozos de testigo de una fila: componentes conexas de la máscara una vez quitados los tacos.
+
+        Parámetros:
+            - mask: Máscara booleana de la fila (alto x ancho de su caja).
+            - markers: Array Kx2 con la extensión (x1, x2) de los tacos en coordenadas de la caja.
+
+        Retorno:
+            - Arrays (x1, x2) de los trozos en coordenadas de la caja.
+    """
+    mask = mask.astype(np.uint8)
+    columns = np.arange(mask.shape[1])
+    if len(markers):
+        in_marker = ((columns[None, :] >= markers[:, :1]) & (columns[None, :] < markers[:, 1:])).any(axis=0)
+        mask[:, in_marker] = 0
+    _, _, stats, _ = cv.connectedComponentsWithStats(mask, connectivity=8)
+    stats = stats[1:] # La componente 0 es el fondo
+    stats = stats[stats[:, cv.CC_STAT_HEIGHT] >= MIN_PIECE_HEIGHT * mask.shape[0]]
+    x1 = stats[:, cv.CC_STAT_LEFT].astype(float)
+    return x1, x1 + stats[:, cv.CC_STAT_WIDTH]
+
+
+def image_pieces(path, depth_from, depth_to):
+    """
+    Trozos de testigo de una imagen en profundidad.
+
+        Retorno:
+            - Arrays (desde, hasta) en metros.
+    """
+    entries = read_masks(path, labels=[CORE, MARKER])
+    rows = [(e, mask) for e, mask in entries if e["label"] == CORE]
+    if not rows:
+        return np.zeros(0), np.zeros(0)
+    boxes = np.array([[e["x"], e["y"], e["x"] + e["width"], e["y"] + e["height"]] for e, _ in rows], dtype=float)
+    markers = np.array([[e["x"], e["y"], e["x"] + e["width"], e["y"] + e["height"]]
+                        for e, _ in entries if e["label"] == MARKER], dtype=float).reshape(-1, 4)
+    order = np.lexsort((boxes[:, 0], (boxes[:, 1] + boxes[:, 3]) / 2))
+    boxes, rows = boxes[order], [rows[i] for i in order]
+
+    position, total = core_axis(boxes, markers)
+    scale = (depth_to - depth_from) / max(total, 1e-6)
+    in_row = vertical_overlap(markers, boxes) > 0.5
+    starts, ends = [], []
+    for r, (e, mask) in enumerate(rows):
+        x1, x2 = row_pieces(mask, markers[in_row[:, r]][:, [0, 2]] - e["x"])
+        starts.append(depth_from + position(x1 + e["x"], r) * scale)
+        ends.append(depth_from + position(x2 + e["x"], r) * scale)
+    return np.concatenate(starts), np.concatenate(ends)
+
+
+def update_rqd(DH, paths=None, images=None):
+    """
+    Recalcula el RQD y la recuperación en los tramos que cubren las imágenes indicadas.
+
+        Parámetros:
+            - DH: Sondeo (General_DH).
+            - paths: Paths de las imágenes nuevas o reprocesadas.
+            - images: Alternativamente, registros de Images.
+    """
+    affected = affected_window(DH, settings.RQD_STEP, paths, images)
+    if affected is None:
+        return 0
+    edges, window = affected
+    low, high = edges[0], edges[-1]
+    # Solo cuentan las imágenes procesadas con máscaras guardadas: las demás no aportan trozos
+    # y bajarían la recuperación y el RQD de sus tramos
+    window = [image for image in window if image.model_version and os.path.exists(mask_paths(image_path(image))[1])]
+
+    pieces = [image_pieces(image_path(image), image.depth_from, image.depth_to) for image in window]
+    starts = np.concatenate([p[0] for p in pieces] or [np.zeros(0)])
+    ends = np.concatenate([p[1] for p in pieces] or [np.zeros(0)])
+    sound = ends - starts >= settings.RQD_MIN_PIECE
+
+    recovered = binned_length(*union(starts, ends), edges)
+    sound_length = binned_length(*union(starts[sound], ends[sound]), edges)
+    covered = binned_length(*union(np.array([i.depth_from for i in window]), np.array([i.depth_to for i in window])), edges)
+    counts, _ = np.histogram((starts + ends) / 2, bins=edges)
+
+    rows = [RQD_DH(DH_id=DH, From=float(a), To=float(b), core_length=float(r), recovery=float(min(r / c, 1)),
+                   RQD=float(min(s / c, 1) * 100), pieces=int(n))
+            for a, b, r, s, n, c in zip(edges[:-1], edges[1:], recovered, sound_length, counts, covered) if c > 0]
+    with transaction.atomic():
+        RQD_DH.objects.filter(DH_id=DH, From__gte=low, To__lte=high).delete()
+        RQD_DH.objects.bulk_create(rows)
+    return len(rows)
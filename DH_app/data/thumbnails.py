@@ -0,0 +1,110 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Miniaturas y versiones web de las imágenes para el visor
+'''
+import os, logging
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import cv2 as cv
+from PIL import Image
+from django.conf import settings
+
+# tipo -> (lado máximo en px, extensión, parámetros de compresión)
+DERIVATIVES = {
+    "thumbs": (settings.THUMBNAIL_SIZE, ".jpg", [cv.IMWRITE_JPEG_QUALITY, 80]),
+    "web": (settings.WEB_IMAGE_SIZE, ".webp", [cv.IMWRITE_WEBP_QUALITY, 80]),
+}
+
+
+def derivative_path(path, kind):
+    """
+    Path de la versión reducida de una imagen: <sondeo>/<kind>/<carpeta>/<nombre>.<ext>
+    (p.ej. S001/thumbs/images/S001_1.jpg para S001/images/S001_1.jpg).
+    """
+    folder, name = os.path.split(path)
+    hole, subfolder = os.path.split(folder)
+    return os.path.join(hole, kind, subfolder, os.path.splitext(name)[0] + DERIVATIVES[kind][1])
+
+
+def image_size(path):
+    """
+    Tamaño (ancho, alto) de una imagen leyendo solo la cabecera, tal como la lee OpenCV
+    (que aplica la orientación EXIF: las fotos giradas 90º intercambian ancho y alto).
+    """
+    with Image.open(path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def _read_reduced(path, max_side):
+    # Decodifica la imagen a la menor escala (1, 1/2, 1/4, 1/8) que sigue siendo mayor que max_side
+    img = cv.imread(path, cv.IMREAD_REDUCED_COLOR_8)
+    if img is None:
+        return None
+    for flag, factor in ((cv.IMREAD_REDUCED_COLOR_8, 8), (cv.IMREAD_REDUCED_COLOR_4, 4), (cv.IMREAD_REDUCED_COLOR_2, 2)):
+        if max(img.shape[:2]) * 8 // factor >= max_side:
+            return img if factor == 8 else cv.imread(path, flag)
+    return cv.imread(path)
+
+
+def make_derivatives(path):
+    """
+    Genera la miniatura y la versión web de una imagen si no existen o están desactualizadas.
+    """
+    mtime = os.path.getmtime(path)
+    for kind, (max_side, _, params) in DERIVATIVES.items():
+        out = derivative_path(path, kind)
+        if os.path.exists(out) and os.path.getmtime(out) >= mtime:
+            continue
+        img = _read_reduced(path, max_side)
+        if img is None:
+            logging.warning(f"No se puede leer la imagen {path}")
+            return
+        scale = max_side / max(img.shape[:2])
+        if scale < 1:
+            img = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        cv.imwrite(out, img, params)
+
+
+def generate_derivatives(paths):
+    # OpenCV libera el GIL al decodificar y codificar, así que los hilos trabajan en paralelo
+    with ThreadPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS) as executor:
+        list(executor.map(make_derivatives, paths))
+
+
+def image_entry(image):
+    """
+    Diccionario con las URLs de la imagen completa, la miniatura y la versión web de una imagen
+    (path relativo a MEDIA_ROOT). Si no existe alguna versión reducida se usa la imagen completa.
+    Los paths se codifican (espacios de los nombres de sondeo) porque srcset separa por espacios.
+    """
+    if not image:
+        return None
+    entry = {"full": settings.MEDIA_URL + quote(image)}
+    for kind, (max_side, _, _) in DERIVATIVES.items():
+        derivative = derivative_path(image, kind)
+        exists = os.path.exists(os.path.join(settings.MEDIA_ROOT, derivative))
+        entry[kind] = settings.MEDIA_URL + quote(derivative if exists else image)
+        entry[f"{kind}_size"] = max_side
+    return entry
@@ -0,0 +1,189 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Guardado de las imágenes subidas: numeración atómica por sondeo en la BD y guardado en paralelo.
+Las imágenes en formatos que muestra el navegador se guardan tal cual (sin decodificar);
+el resto se convierte a JPEG.
+'''
+import os, re, shutil, logging
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from DH_app.models import Image_sequence
+from DH_app.data.manifest import image_fields, register_image
+from DH_app.data.thumbnails import generate_derivatives
+from DH_app.data.preprocess import preprocess_images
+
+NUMBER = re.compile(r"_(\d+)\.[^.]+$")
+# Formatos que se guardan sin convertir (PIL) -> extensión
+DISPLAYABLE = {"JPEG": ".jpg", "MPO": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+# Miniaturas y preprocesado de las subidas, fuera de la petición (un hilo: las operaciones
+# ya se reparten en THUMBNAIL_WORKERS y PREPROCESS_WORKERS hilos)
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="uploads")
+
+
+def image_number(name):
+    # Número de una imagen <sondeo>_<n>.<ext> (0 si no sigue la nomenclatura)
+    match = NUMBER.search(name)
+    return int(match.group(1)) if match else 0
+
+
+def last_on_disk(folder):
+    # Mayor número de imagen de la carpeta (comparación numérica: S001_10 va después de S001_2)
+    if not os.path.isdir(folder):
+        return 0
+    return max((image_number(entry.name) for entry in os.scandir(folder) if entry.is_file()), default=0)
+
+
+def allocate_numbers(DH, count, folder):
+    """
+    Reserva count números consecutivos de imagen para el sondeo. El contador se actualiza
+    en una única sentencia dentro de una transacción, así que dos subidas simultáneas
+    nunca reciben el mismo número. La primera vez se inicializa con las imágenes de la carpeta.
+
+        Retorno:
+            - range con los números reservados.
+    """
+    try:
+        Image_sequence.objects.get_or_create(DH_id=DH, defaults={"last": last_on_disk(folder)})
+    except IntegrityError: # Creado a la vez por otra petición
+        pass
+    with transaction.atomic():
+        Image_sequence.objects.filter(DH_id=DH).update(last=F("last") + count)
+        last = Image_sequence.objects.get(DH_id=DH).last
+    return range(last - count + 1, last + 1)
+
+
+def inspect_upload(file):
+    """
+    Formato y tamaño de una imagen subida leyendo solo la cabecera (PIL no decodifica los píxeles).
+
+        Excepciones:
+            - ValueError si no es una imagen o su tamaño está fuera de los límites.
+    """
+    try:
+        with Image.open(file) as img:
+            fmt, (width, height) = img.format, img.size
+    except Exception as e:
+        raise ValueError(f"{getattr(file, 'name', 'El fichero')} no es una imagen válida ({e})")
+    finally:
+        file.seek(0)
+    if min(width, height) < settings.UPLOAD_MIN_SIDE or width * height > settings.UPLOAD_MAX_PIXELS:
+        raise ValueError(f"Tamaño de imagen no admitido: {width}x{height}")
+    return fmt, (width, height)
+
+
+def write_upload(file, path):
+    # Copia los bytes originales por bloques (desde el fichero temporal si Django lo guardó en disco)
+    tmp = f"{path}.{os.getpid()}.part"
+    try:
+        if hasattr(file, "temporary_file_path"):
+            shutil.copyfile(file.temporary_file_path(), tmp)
+        else:
+            with open(tmp, "wb") as out:
+                if hasattr(file, "chunks"):
+                    for chunk in file.chunks():
+                        out.write(chunk)
+                else:
+                    shutil.copyfileobj(file, out, 1024 * 1024)
+        os.replace(tmp, path)
+    except OSError: # Disco lleno...: no se deja el fichero a medias
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def save_image(file, stem):
+    """
+    Guarda una imagen subida como <stem>.<ext>. Si el navegador puede mostrarla se guardan los
+    bytes originales; si no (TIFF, BMP...) se convierte a JPEG.
+
+        Retorno:
+            - Tupla (path, hashes y metadatos para el manifiesto).
+    """
+    fmt, _ = inspect_upload(file)
+    if fmt in DISPLAYABLE:
+        path = stem + DISPLAYABLE[fmt]
+        write_upload(file, path)
+    else:
+        path = stem + ".jpg"
+        with Image.open(file) as img:
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(path, "JPEG", quality=95)
+    return path, image_fields(path)
+
+
+def save_uploads(DH, files, folder):
+    """
+    Guarda las imágenes subidas como <sondeo>_<n>.<ext> y las registra en el manifiesto.
+    La escritura y los hashes liberan el GIL, así que las imágenes se guardan en paralelo;
+    los registros en la BD se hacen desde el hilo de la petición.
+
+        Retorno:
+            - Lista de paths de las imágenes guardadas.
+
+        Excepciones:
+            - ValueError si algún fichero no es una imagen válida (no se guarda ninguno).
+            - El primer error al guardar (OSError...); las imágenes ya guardadas quedan registradas.
+    """
+    # Se validan todas antes de reservar números y escribir nada
+    for file in files:
+        inspect_upload(file)
+    os.makedirs(folder, exist_ok=True)
+    numbers = allocate_numbers(DH, len(files), folder)
+    stems = [os.path.join(folder, f"{DH.DH_id}_{n}") for n in numbers]
+    saved, error = [], None
+    with ThreadPoolExecutor(max_workers=settings.UPLOAD_WORKERS) as executor:
+        for future in [executor.submit(save_image, file, stem) for file, stem in zip(files, stems)]:
+            try:
+                path, image_data = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            register_image(DH, path, image_data)
+            saved.append(path)
+    if error:
+        raise error
+    return saved
+
+
+def _derivatives(paths):
+    try:
+        generate_derivatives(paths)
+        preprocess_images(paths)
+    except Exception as e:
+        logging.error(f"Error al generar las versiones de {len(paths)} imágenes: {e}")
+
+
+def finish_uploads(paths, background=True):
+    """
+    Genera las miniaturas y las imágenes preprocesadas de las imágenes guardadas. Por defecto
+    en segundo plano para que la petición responda en cuanto los ficheros están en disco:
+    mientras tanto el visor usa la imagen completa y process_imgs preprocesa las que falten.
+    """
+    if not paths:
+        return
+    if background:
+        _background.submit(_derivatives, list(paths))
+    else:
+        _derivatives(paths)
@@ -34,6 +34,19 @@ import pandas as pd
 import json, os, csv
 from PIL import Image
 from DH_app.data.process_images import *
+from DH_app.data.jobs import enqueue_job, job_status
+from DH_app.data.admission import InferenceBusy
+from DH_app.data.detections import detection_summary
+from DH_app.data.manifest import pending_images
+from DH_app.data.model_cache import model_version
+from DH_app.data.model_registry import active_model_path
+from DH_app.data.thumbnails import image_entry, DERIVATIVES
+from DH_app.data.overlays import overlay_path, processed_entry
+from DH_app.data.uploads import save_uploads, finish_uploads
+from DH_app.data.archive_import import import_archive as import_archive_file, report_message
+from DH_app.data.chunked_upload import open_session, write_chunk, session_status, UploadConflict
+from django.http import FileResponse, Http404
+from django.db.models import F
 #import plotly.express as px
 
 def filter_DH (project):
@@ -375,35 +388,88 @@ def upload_imgs(request):
     elif request.method == "POST":
         form = UploadFileForm(request.POST, request.FILES)
         ID = request.POST.get("DH_id")
+        DH = General_DH.objects.get(DH_id=ID)
         DH_data = General_DH.objects.filter(DH_id=ID).values().first()
         path = create_directory(DH_data["project_id"], DH_data["DH_id"]) # path a la carpeta del sondeo
         try:
             if request.FILES.getlist("Images"):
-                count = 0
                 img_files = request.FILES.getlist("Images")
                 folder_path = os.path.join(path,"images")
-                for file in img_files:
-                    img_files = [i for i in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, i))]
-                    img_files.sort()
-                    if img_files:
-                        last_img = img_files[-1]
-                        last_num = int(last_img.split("_")[-1].split(".")[0]) + 1
-                    else:
-                        last_num = 1
-                    path_img = os.path.join(folder_path,str(ID)+f"_{last_num}.jpg")
-                    img =  Image.open (file)
-                    img.save(path_img)
-                    count +=1
+                # Números de imagen reservados en la BD y guardado en paralelo
+                saved = save_uploads(DH, img_files, folder_path)
+                count = len(saved)
+                finish_uploads(saved)
                 message = f"{count} Imagenes importadas correctamente"
                 return render(request, "data/import_files.html", {"message": message})
             else: raise FileNotFoundError
 
+        except ValueError as e: # Fichero que no es una imagen o con tamaño no admitido
+            return render(request, "data/import_files.html", {"error": f"Error al importar las imagenes: {e}"})
+
         except Exception as e:
-            logging.ERROR("Upload ERROR:", e)
+            logging.error(f"Upload ERROR: {e}")
             error = "Se ha producido un error al importar las imagenes."
             return render(request, "data/import_files.html", {"error": error})
 
 
+'''
+Subidas por partes reanudables (ver DH_app.data.chunked_upload)
+'''
+@login_required(login_url=settings.LOGIN_URL)
+@api_view(["POST"])
+@permission_required("DH_app.add_images")
+def upload_session(request):
+    DH = get_object_or_404(General_DH, DH_id=request.data.get("DH_id"))
+    try:
+        session = open_session(DH, request.data.get("filename", ""), int(request.data.get("size")),
+                               request.data.get("sha256", ""), request.user)
+    except (TypeError, ValueError) as e:
+        return Response({"error": f"Datos de la subida no válidos: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(session_status(session), status=status.HTTP_201_CREATED)
+
+@login_required(login_url=settings.LOGIN_URL)
+@api_view(["GET", "PUT"])
+@permission_required("DH_app.add_images")
+def upload_chunk(request, token):
+    session = get_object_or_404(Upload_session, token=token)
+    if request.method == "GET":
+        return Response(session_status(session))
+    try:
+        offset = int(request.headers.get("Upload-Offset"))
+        length = int(request.headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        return Response({"error": "Faltan las cabeceras Upload-Offset y Content-Length."}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        session = write_chunk(session, offset, request.stream, length)
+    except UploadConflict as e:
+        return Response(dict(session_status(session), offset=e.offset), status=status.HTTP_409_CONFLICT)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if session.state == Upload_session.FAILED:
+        return Response(session_status(session), status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return Response(session_status(session))
+
+'''
+Importar las imágenes de un fichero comprimido (ZIP/TAR) en los sondeos de un proyecto
+'''
+@login_required(login_url=settings.LOGIN_URL)
+@api_view(["POST"])
+@permission_required("DH_app.add_images")
+def import_archive(request):
+    archive = request.FILES.get("archive")
+    if not archive:
+        return render(request, "data/import_files.html", {"error": "No hay ningún fichero para importar."})
+    try:
+        report = import_archive_file(archive, project=request.POST.get("project_id") or None)
+    except ValueError as e:
+        return render(request, "data/import_files.html", {"error": f"Error al importar el fichero: {e}"})
+    except Exception as e:
+        logging.error(f"Archive import ERROR: {e}")
+        return render(request, "data/import_files.html", {"error": "Se ha producido un error al importar el fichero."})
+    imported = sum(c["imported"] for c in report["holes"].values())
+    return render(request, "data/import_files.html", {"message": f"{imported} Imagenes importadas correctamente", "report": report_message(report)})
+
+
 @login_required(login_url=settings.LOGIN_URL)
 @api_view(["POST"])
 @permission_required("DH_app.add_lithos_dh")
@@ -471,67 +537,110 @@ def import_litho (request):
 def show_images(request):
     project_id = request.GET.get("project_id")
     DH_id = request.GET.get("DH_id")
-    path = create_directory (project_id, DH_id)
-    images_path = os.path.join(path, "images")
-    p_images_path = os.path.join(path, "processed_imgs")
-
-    images = list_images(images_path)
-    p_images= list_images(p_images_path)
-    print (images_path)
-    show_images = []
-    if not images:
+    DH = General_DH.objects.filter(DH_id=DH_id).first()
+
+    # Se muestran miniaturas/versiones web con enlace a la imagen completa; las procesadas
+    # se dibujan bajo demanda con los filtros de clase y confianza de la petición
+    labels, min_conf = overlay_filters(request)
+    show_images = hole_images(DH, labels, min_conf) if DH else []
+    if not show_images:
         error = "No hay imágenes para este sondeo. "
         return render(request, "data/show_images.html", {"error": error, "DH_id":DH_id, "project": project_id})
 
-    if len(images) > len(p_images):
-        p_images.extend([None]*(len(images)-len(p_images)))
-        for i, j in zip(images, p_images):
-            show_images.append([i,j])
-    else:
-        show_images = zip(images, p_images)
-    return render(request, "data/show_images.html", {"images":show_images, "MEDIA_URL":settings.MEDIA_URL, "DH_id":DH_id, "project": project_id})
+    # Imágenes pendientes de procesar según el manifiesto
+    pending = None
+    model_path = active_model_path(DH.project_id)
+    if model_path and os.path.exists(model_path):
+        pending = pending_images(DH, model_version(model_path)).count()
+    return render(request, "data/show_images.html", {"images":show_images, "DH_id":DH_id, "project": project_id, "pending": pending})
 
 @login_required(login_url=settings.LOGIN_URL)
 @api_view(["POST"])
 @permission_required("DH_app.add_images")
 def process_images(request):
+    error = ""
     try:
         project_name= request.POST.get("project_id")
-        if " " in project_name:
-            project_id = project_name.replace(" ","_")
-        else:
-            project_id = project_name
         DH_name = request.POST.get("DH_id")
-        if " "in DH_name:
-            DH_id = DH_name.replace(" ","_")
-        else:
-            DH_id = DH_name
-        path = create_directory (project_id, DH_id)
+        DH = General_DH.objects.get(DH_id=DH_name)
 
-        model_path = settings.DL_MODEL_PATH
+        model_path = active_model_path(project_name)
         if os.path.exists(model_path):
             pass
         else:
             error = "El modelo introducido no es válido."
             raise FileNotFoundError
 
-        if not list_images(os.path.join(path,"images")):
+        if not Images.objects.filter(DH_id=DH, width__isnull=False).exists():
             error = "No hay imágenes para este sondeo."
             raise FileNotFoundError
         else:
-            process_imgs(path, model_path)
-            images_path = os.path.join(path, "images")
-            p_images_path = os.path.join(path, "processed_imgs")
-            images = list_images(images_path)
-            p_images= list_images(p_images_path)
-            show_images = zip(images, p_images)
-            return render(request, "data/show_images.html", {"images":show_images, "MEDIA_URL":settings.MEDIA_URL, "DH_id":DH_name, "project": project_name})
+            # El procesado se encola y lo ejecutan los workers (manage.py process_worker)
+            try:
+                job = enqueue_job(DH, request.user)
+            except InferenceBusy:
+                busy = "El servidor está ocupado procesando otros sondeos. Inténtelo más tarde."
+                return render(request, "data/show_images.html", {"busy": busy}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            show_images = hole_images(DH)
+            return render(request, "data/show_images.html", {"images":show_images, "DH_id":DH_name, "project": project_name, "job": job})
 
     except Exception as e:
         error_render= "Error al procesar las imágenes. "+ error
         # logging.ERROR(str(e))
         return render(request, "data/show_images.html", {"error":error_render})
 
+def hole_images(DH, labels=None, min_conf=0):
+    # Imágenes del sondeo desde la BD (una consulta, sin listar la carpeta), por profundidad
+    images = Images.objects.filter(DH_id=DH, width__isnull=False).order_by(F("depth_from").asc(nulls_last=True), "ID").values_list("Images", "model_version")
+    return [[image_entry(image), processed_entry(image, labels, min_conf, bool(version))] for image, version in images]
+
+def overlay_filters(request):
+    # Filtros de las imágenes procesadas: ?labels=Testigo,Cota&conf=0.5
+    labels = [l for l in request.GET.get("labels", "").split(",") if l] or None
+    try:
+        min_conf = float(request.GET.get("conf", 0))
+    except ValueError:
+        min_conf = 0
+    return labels, min_conf
+
+'''
+Imagen procesada dibujada bajo demanda a partir de las máscaras guardadas
+'''
+@login_required(login_url=settings.LOGIN_URL)
+@api_view(["GET"])
+@permission_required("DH_app.view_images")
+def show_overlay(request):
+    media_root = os.path.realpath(settings.MEDIA_ROOT)
+    image = os.path.realpath(os.path.join(media_root, request.GET.get("image", "")))
+    if not image.startswith(media_root + os.sep) or not os.path.isfile(image):
+        raise Http404("La imagen no existe.")
+    size = request.GET.get("size")
+    max_side = DERIVATIVES[size][0] if size in DERIVATIVES else None
+    labels, min_conf = overlay_filters(request)
+    path = overlay_path(image, labels, min_conf, max_side)
+    if path is None:
+        raise Http404("No se puede leer la imagen.")
+    return FileResponse(open(path, "rb"), content_type="image/jpeg")
+
+@login_required(login_url=settings.LOGIN_URL)
+@api_view(["GET"])
+@permission_required("DH_app.view_images")
+def process_status(request):
+    job = get_object_or_404(Process_job, ID=request.GET.get("job"))
+    return Response(job_status(job))
+
+'''
+Resumen por clase de las detecciones de un sondeo
+'''
+@login_required(login_url=settings.LOGIN_URL)
+@api_view(["GET"])
+@permission_required("DH_app.view_detections_dh")
+def show_detections(request):
+    DH_id = request.GET.get("DH_id")
+    sondeo = get_object_or_404(General_DH, DH_id=DH_id)
+    data = detection_summary(sondeo, request.GET.get("label"))
+    return Response({"DH_id": DH_id, "detections": data})
+
 
 @login_required(login_url=settings.LOGIN_URL)
 @api_view(["GET"])
@@ -567,6 +676,32 @@ def show_deviations(request):
         return Response( status=status.HTTP_400_BAD_REQUEST)
 
 
+@login_required(login_url=settings.LOGIN_URL)
+@api_view(["GET"])
+@permission_required("DH_app.view_fracture_dh")
+def show_fractures(request):
+    if request.method == "GET":
+        DH_id = request.GET.get("DH_id")
+        sondeo = get_object_or_404(General_DH, DH_id=DH_id)
+        data = Fracture_DH.objects.filter(DH_id=sondeo).order_by("From").values("From", "To", "fract_length", "intensity")
+        return Response({"DH_id": DH_id, "fractures": list(data)})
+    else:
+        return Response( status=status.HTTP_400_BAD_REQUEST)
+
+
+@login_required(login_url=settings.LOGIN_URL)
+@api_view(["GET"])
+@permission_required("DH_app.view_rqd_dh")
+def show_rqd(request):
+    if request.method == "GET":
+        DH_id = request.GET.get("DH_id")
+        sondeo = get_object_or_404(General_DH, DH_id=DH_id)
+        data = RQD_DH.objects.filter(DH_id=sondeo).order_by("From").values("From", "To", "core_length", "recovery", "RQD", "pieces")
+        return Response({"DH_id": DH_id, "RQD": list(data)})
+    else:
+        return Response( status=status.HTTP_400_BAD_REQUEST)
+
+
 @login_required(login_url=settings.LOGIN_URL)
 @api_view(["GET"])
 @permission_required("DH_app.view_lithos_dh")
@@ -0,0 +1,137 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, time, json, resource, platform, tempfile
+from datetime import datetime
+from itertools import cycle, islice
+import numpy as np
+import cv2 as cv
+import torch, ultralytics
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from DH_app.data.model_cache import get_model, clear_models
+from DH_app.data.process_images import batches
+
+STAGES = ("load", "decode", "inference", "plot", "write")
+# Métricas que se comparan entre ejecuciones (True: mayor es mejor)
+METRICS = {"images_per_s": True, "latency_p50": False, "latency_p95": False, "peak_rss_mb": False}
+
+
+def peak_rss_mb():
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if platform.system() == "Darwin" else rss / 1024
+
+
+'''
+Benchmark del procesado de imágenes (carga del modelo, decodificación, inferencia, dibujo y escritura):
+    python manage.py benchmark_inference --replicate 100 --output bench.json --compare bench_anterior.json
+'''
+class Command(BaseCommand):
+    help = "Mide el rendimiento del procesado de imágenes con el modelo de Deep Learning."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", default=os.path.join(settings.BASE_DIR, "sample _data"), help="Carpeta con imágenes.")
+        parser.add_argument("--replicate", type=int, default=0, help="Número total de imágenes (se repiten las de la carpeta).")
+        parser.add_argument("--batch", type=int, default=settings.DL_BATCH_SIZE, help="Imágenes por lote.")
+        parser.add_argument("--model", default=settings.DL_MODEL_PATH, help="Path al modelo.")
+        parser.add_argument("--backend", default=settings.DL_BACKEND, help="Backend de inferencia.")
+        parser.add_argument("--threads", type=int, default=None, help="Hilos de torch.")
+        parser.add_argument("--output", default=None, help="Fichero JSON donde guardar los resultados.")
+        parser.add_argument("--compare", default=None, help="Fichero JSON de una ejecución anterior para comparar.")
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options["model"]):
+            raise CommandError(f"El modelo {options['model']} no existe.")
+        names = sorted(f for f in os.listdir(options["images"]) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+        if not names:
+            raise CommandError("No hay imágenes en la carpeta indicada.")
+        if options["threads"]:
+            torch.set_num_threads(options["threads"])
+        paths = [os.path.join(options["images"], n) for n in names]
+        paths = list(islice(cycle(paths), options["replicate"] or len(paths)))
+
+        stages = dict.fromkeys(STAGES, 0.0)
+        latencies = []
+        clear_models()
+        start = time.perf_counter()
+        model = get_model(options["model"], options["backend"])
+        stages["load"] = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            start_run = time.perf_counter()
+            for n_batch, batch in enumerate(batches(paths, options["batch"])):
+                start = time.perf_counter()
+                imgs = [cv.imread(p) for p in batch]
+                decode = time.perf_counter() - start
+                start = time.perf_counter()
+                results = list(model(imgs, verbose=False))
+                inference = time.perf_counter() - start
+                stages["decode"] += decode
+                stages["inference"] += inference
+                for i, result in enumerate(results):
+                    start = time.perf_counter()
+                    plotted = result.plot()
+                    plot = time.perf_counter() - start
+                    start = time.perf_counter()
+                    cv.imwrite(os.path.join(out_dir, f"{n_batch}_{i}.jpg"), plotted)
+                    write = time.perf_counter() - start
+                    stages["plot"] += plot
+                    stages["write"] += write
+                    # Latencia por imagen: parte proporcional del lote + su dibujo y escritura
+                    latencies.append((decode + inference) / len(batch) + plot + write)
+            elapsed = time.perf_counter() - start_run
+
+        report = {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "versions": {"torch": torch.__version__, "ultralytics": ultralytics.__version__,
+                         "opencv": cv.__version__, "numpy": np.__version__, "python": platform.python_version()},
+            "config": {"images": len(paths), "batch": options["batch"], "backend": options["backend"],
+                       "threads": torch.get_num_threads(), "model": os.path.basename(options["model"]), "cpu": platform.processor()},
+            "images_per_s": len(paths) / elapsed,
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": stages,
+        }
+
+        self.stdout.write(f"{len(paths)} imágenes, lote {options['batch']}, backend {options['backend']}, {report['config']['threads']} hilos")
+        self.stdout.write(f"{report['images_per_s']:.2f} img/s, p50 {report['latency_p50']:.3f} s, "
+                          f"p95 {report['latency_p95']:.3f} s, RSS máx. {report['peak_rss_mb']:.0f} MB")
+        total = sum(stages.values())
+        for stage, seconds in stages.items():
+            self.stdout.write(f"  {stage:<10}{seconds:>10.3f} s{seconds / total:>8.1%}")
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                previous = json.load(f)
+            self.stdout.write(f"Comparación con {options['compare']} ({previous.get('date')}):")
+            for metric, higher_better in METRICS.items():
+                if previous.get(metric) is None:
+                    self.stdout.write(self.style.WARNING(f"  {metric:<14}{'(sin dato)':>10} -> {report[metric]:>10.3f}"))
+                    continue
+                ratio = report[metric] / previous[metric] if previous[metric] else float("nan")
+                better = ratio >= 1 if higher_better else ratio <= 1
+                style = self.style.SUCCESS if better else self.style.WARNING
+                self.stdout.write(style(f"  {metric:<14}{previous[metric]:>10.3f} -> {report[metric]:>10.3f} (x{ratio:.2f})"))
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Resultados guardados en {options['output']}")
@@ -0,0 +1,113 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, time
+import numpy as np
+import cv2 as cv
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from DH_app.data.model_cache import get_model
+from DH_app.data.process_images import predict_tiled, result_detections, match_detections, check_tiling
+
+
+def read_labels(label_path, width, height):
+    # Etiquetas YOLO (detección o segmentación) -> lista de (clase, caja en px)
+    labels = []
+    if not os.path.exists(label_path):
+        return labels
+    with open(label_path) as f:
+        for line in f:
+            values = line.split()
+            if len(values) < 5:
+                continue
+            cls, coords = int(values[0]), np.array(values[1:], dtype=float)
+            if len(coords) == 4:
+                cx, cy, w, h = coords
+                box = [cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2]
+            else:
+                xy = coords.reshape(-1, 2)
+                box = [*xy.min(axis=0), *xy.max(axis=0)]
+            labels.append((cls, np.array(box) * [width, height, width, height]))
+    return labels
+
+
+def matched(reference, detections, threshold):
+    # Número de objetos de referencia (clase, caja) encontrados en las detecciones
+    reference = [{"cls": cls, "box": box, "conf": 1.0} for cls, box in reference]
+    return len(match_detections(reference, detections, threshold))
+
+
+'''
+Compara coste y recall de la inferencia por teselas frente a la imagen completa:
+    python manage.py benchmark_tiling --images "sample _data" --tile 640 --overlap 128
+'''
+class Command(BaseCommand):
+    help = "Compara la inferencia por teselas con la inferencia sobre la imagen completa."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", default=os.path.join(settings.BASE_DIR, "sample _data"), help="Carpeta con imágenes.")
+        parser.add_argument("--labels", default=None, help="Carpeta con etiquetas YOLO (.txt) para calcular el recall.")
+        parser.add_argument("--model", default=settings.DL_MODEL_PATH, help="Path al modelo.")
+        parser.add_argument("--tile", type=int, default=settings.DL_TILE_SIZE, help="Tamaño de tesela (px).")
+        parser.add_argument("--overlap", type=int, default=settings.DL_TILE_OVERLAP, help="Solape entre teselas (px).")
+        parser.add_argument("--iou", type=float, default=0.5, help="IoU mínimo para considerar un objeto encontrado.")
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options["model"]):
+            raise CommandError(f"El modelo {options['model']} no existe.")
+        names = sorted(f for f in os.listdir(options["images"]) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+        if not names:
+            raise CommandError("No hay imágenes en la carpeta indicada.")
+        try:
+            check_tiling(options["tile"], options["overlap"])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        model = get_model(options["model"])
+        model(np.zeros((options["tile"], options["tile"], 3), dtype=np.uint8), verbose=False) # calentamiento
+        stats = {mode: {"time": 0.0, "detections": 0, "found": 0} for mode in ("full", "tiled")}
+        reference_total = 0
+
+        for name in names:
+            img = cv.imread(os.path.join(options["images"], name))
+            start = time.perf_counter()
+            full = result_detections(model(img, verbose=False)[0])
+            stats["full"]["time"] += time.perf_counter() - start
+            start = time.perf_counter()
+            tiled = predict_tiled(model, img, options["tile"], options["overlap"])
+            stats["tiled"]["time"] += time.perf_counter() - start
+
+            if options["labels"]:
+                label_path = os.path.join(options["labels"], os.path.splitext(name)[0] + ".txt")
+                reference = read_labels(label_path, img.shape[1], img.shape[0])
+            else:
+                # Sin etiquetas, la referencia es la inferencia sobre la imagen completa
+                reference = [(d["cls"], d["box"]) for d in full]
+            reference_total += len(reference)
+            for mode, detections in (("full", full), ("tiled", tiled)):
+                stats[mode]["detections"] += len(detections)
+                stats[mode]["found"] += matched(reference, detections, options["iou"])
+
+        reference_name = "etiquetas" if options["labels"] else "imagen completa"
+        self.stdout.write(f"{len(names)} imágenes, tesela {options['tile']} px, solape {options['overlap']} px, referencia: {reference_name}")
+        self.stdout.write(f"{'modo':<8}{'s/imagen':>10}{'detecciones':>14}{'recall':>10}")
+        for mode, values in stats.items():
+            recall = values["found"] / reference_total if reference_total else float("nan")
+            self.stdout.write(f"{mode:<8}{values['time'] / len(names):>10.3f}{values['detections']:>14}{recall:>10.2%}")
+        self.stdout.write(f"Coste relativo de las teselas: x{stats['tiled']['time'] / max(stats['full']['time'], 1e-9):.2f}")
@@ -0,0 +1,89 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, time
+import cv2 as cv
+from ultralytics import YOLO
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from DH_app.data.model_cache import EXPORT_BACKENDS, export_model, get_model
+from DH_app.data.process_images import result_detections, match_detections, batches
+
+
+'''
+Exporta el modelo y comprueba que el backend exportado da las mismas detecciones que PyTorch:
+    python manage.py check_backend --backend onnx
+'''
+class Command(BaseCommand):
+    help = "Comprueba que las detecciones de un backend exportado coinciden con las de PyTorch."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backend", default="onnx", choices=list(EXPORT_BACKENDS), help="Backend a comprobar.")
+        parser.add_argument("--images", default=os.path.join(settings.BASE_DIR, "sample _data"), help="Carpeta con imágenes.")
+        parser.add_argument("--model", default=settings.DL_MODEL_PATH, help="Path al modelo.")
+        parser.add_argument("--iou", type=float, default=0.9, help="IoU mínimo entre cajas emparejadas.")
+        parser.add_argument("--conf-tol", type=float, default=0.05, help="Diferencia máxima de confianza.")
+        parser.add_argument("--min-match", type=float, default=0.95, help="Fracción mínima de detecciones emparejadas.")
+        parser.add_argument("--batch", type=int, default=settings.DL_BATCH_SIZE, help="Imágenes por lote (como en process_imgs).")
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options["model"]):
+            raise CommandError(f"El modelo {options['model']} no existe.")
+        names = sorted(f for f in os.listdir(options["images"]) if f.lower().endswith((".jpg", ".jpeg", ".png")))
+        if not names:
+            raise CommandError("No hay imágenes en la carpeta indicada.")
+
+        path = export_model(options["model"], options["backend"])
+        self.stdout.write(f"Modelo exportado: {path}")
+        # El artefacto exportado se carga directamente: get_model volvería a PyTorch si no se puede cargar
+        try:
+            exported_model = YOLO(path, task="segment")
+        except Exception as e:
+            raise CommandError(f"No se puede cargar el modelo exportado {path}: {e}")
+        models = {"torch": get_model(options["model"], "torch"), options["backend"]: exported_model}
+
+        times = dict.fromkeys(models, 0.0)
+        reference_total, matched, conf_diff = 0, 0, 0.0
+        # Por lotes, como en producción: un modelo exportado con lote fijo falla aquí
+        for batch in batches(names, options["batch"]):
+            imgs = [cv.imread(os.path.join(options["images"], name)) for name in batch]
+            detections = {}
+            for backend, model in models.items():
+                start = time.perf_counter()
+                try:
+                    detections[backend] = [result_detections(r) for r in model(imgs, verbose=False)]
+                except Exception as e:
+                    raise CommandError(f"Error al procesar un lote de {len(imgs)} imágenes con {backend}: {e}")
+                times[backend] += time.perf_counter() - start
+            for name, reference, exported in zip(batch, detections["torch"], detections[options["backend"]]):
+                pairs = match_detections(reference, exported, options["iou"])
+                pairs = [(i, j) for i, j in pairs if abs(reference[i]["conf"] - exported[j]["conf"]) <= options["conf_tol"]]
+                for i, j in pairs:
+                    conf_diff = max(conf_diff, abs(reference[i]["conf"] - exported[j]["conf"]))
+                reference_total += max(len(reference), len(exported))
+                matched += len(pairs)
+                self.stdout.write(f"{name}: {len(reference)} (torch) / {len(exported)} ({options['backend']}), {len(pairs)} coinciden")
+
+        ratio = matched / reference_total if reference_total else 1.0
+        for backend, seconds in times.items():
+            self.stdout.write(f"{backend}: {seconds / len(names):.3f} s/imagen")
+        self.stdout.write(f"Detecciones coincidentes: {ratio:.2%} (diferencia máxima de confianza {conf_diff:.3f})")
+        if ratio < options["min_match"]:
+            raise CommandError(f"El backend {options['backend']} no coincide con PyTorch dentro de la tolerancia.")
+        self.stdout.write(self.style.SUCCESS(f"El backend {options['backend']} coincide con PyTorch."))
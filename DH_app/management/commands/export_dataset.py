@@ -0,0 +1,180 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, re, json, shutil, hashlib, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import cv2 as cv
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from DH_app.models import Images, Detections_DH
+from DH_app.data.fracture_log import FRACTURE, CORE, MARKER
+from DH_app.data.manifest import image_path
+from DH_app.data.mask_store import mask_paths, read_masks
+from DH_app.data.preprocess import inference_input
+from DH_app.data.thumbnails import image_size
+
+MANIFEST = ".export_manifest.json"
+
+
+def mask_polygon(mask, x, y):
+    # Mayor contorno de una máscara (coordenadas de la imagen), simplificado a 1 px
+    contours, _ = cv.findContours(mask.astype(np.uint8), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    contour = cv.approxPolyDP(max(contours, key=cv.contourArea), 1, True).reshape(-1, 2)
+    return contour + [x, y] if len(contour) >= 3 else None
+
+
+def export_item(task):
+    """
+    Copia una imagen al dataset y escribe sus etiquetas en formato de segmentación YOLO
+    (una línea por objeto: clase y polígono normalizado). Se ejecuta en los procesos del pool.
+    """
+    source, image, boxes, image_out, label_out, min_conf = task
+    width, height = image_size(source)
+    lines = []
+    masks = read_masks(image, min_conf=min_conf)
+    if masks:
+        for e, mask in masks:
+            polygon = mask_polygon(mask, e["x"], e["y"])
+            if polygon is not None:
+                lines.append((e["cls"], polygon))
+    else:
+        # Sin máscaras guardadas se usan las cajas de las detecciones de la BD
+        for cls, x1, y1, x2, y2 in boxes:
+            lines.append((cls, np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])))
+
+    for path in (image_out, label_out):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(image_out):
+        os.remove(image_out)
+    try:
+        os.link(source, image_out) # Sin copia si están en el mismo sistema de ficheros
+    except OSError:
+        shutil.copyfile(source, image_out)
+    scale = np.array([width, height], dtype=float)
+    with open(label_out, "w") as f:
+        for cls, polygon in lines:
+            coords = np.clip(polygon / scale, 0, 1).ravel()
+            f.write(f"{cls} " + " ".join(f"{v:.5f}" for v in coords) + "\n")
+    return len(lines)
+
+
+def item_key(image, source, min_conf):
+    # Cambia si cambia la imagen, sus máscaras o sus detecciones
+    _, index_path = mask_paths(image_path(image))
+    sha = hashlib.sha1(f"{image.content_hash}|{image.model_version}|{source}|{min_conf}".encode())
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def split_of(DH_id, val):
+    # Reparto estable por sondeo: las imágenes de un sondeo no se reparten entre train y val
+    return "val" if int(hashlib.md5(DH_id.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF < val else "train"
+
+
+'''
+Genera un dataset de segmentación YOLO (train/val) con las imágenes y detecciones de la BD:
+    python manage.py export_dataset --output modelo/DH_dataset --val 0.2 --workers 8
+Solo se vuelven a exportar las imágenes cuyo contenido o detecciones han cambiado.
+'''
+class Command(BaseCommand):
+    help = "Exporta las imágenes y detecciones a un dataset de entrenamiento YOLO."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=os.path.join(settings.BASE_DIR, "modelo", "DH_dataset"), help="Carpeta del dataset.")
+        parser.add_argument("--project", default=None, help="Exportar solo las imágenes de este proyecto.")
+        parser.add_argument("--val", type=float, default=0.2, help="Fracción de sondeos de validación.")
+        parser.add_argument("--min-conf", type=float, default=0.25, help="Confianza mínima de las detecciones.")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Número de procesos.")
+
+    def handle(self, *args, **options):
+        output = os.path.abspath(options["output"])
+        min_conf = options["min_conf"]
+        os.makedirs(output, exist_ok=True)
+        manifest_path = os.path.join(output, MANIFEST)
+        previous = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                previous = json.load(f)
+
+        images = Images.objects.filter(model_version__gt="").select_related("DH_id")
+        if options["project"]:
+            images = images.filter(project_id=options["project"])
+        boxes = {}
+        for image_id, cls, x1, y1, x2, y2 in Detections_DH.objects.filter(image__in=images, confidence__gte=min_conf).values_list(
+                "image_id", "class_id", "x1", "y1", "x2", "y2"):
+            boxes.setdefault(image_id, []).append((cls, x1, y1, x2, y2))
+
+        manifest, tasks = {}, []
+        for image in images:
+            path = image_path(image)
+            if not os.path.exists(path):
+                continue
+            source = inference_input(path)
+            split = split_of(image.DH_id.DH_id, options["val"])
+            stem = re.sub(r"[^\w.-]", "_", f"{image.project_id}_{image.DH_id.DH_id}_{os.path.splitext(os.path.basename(path))[0]}")
+            image_out = os.path.join(output, "images", split, stem + os.path.splitext(source)[1])
+            label_out = os.path.join(output, "labels", split, stem + ".txt")
+            key = item_key(image, source, min_conf)
+            manifest[stem] = {"key": key, "files": [image_out, label_out]}
+            if previous.get(stem, {}).get("key") == key and all(os.path.exists(p) for p in (image_out, label_out)):
+                continue
+            tasks.append((source, path, boxes.get(image.ID, []), image_out, label_out, min_conf))
+
+        # Imágenes que ya no están en la BD (o han cambiado de split)
+        removed = 0
+        for stem, item in previous.items():
+            for path in set(item["files"]) - set(manifest.get(stem, {}).get("files", [])):
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed += 1
+
+        start = time.perf_counter()
+        exported, objects = 0, 0
+        if tasks:
+            # Los procesos hijos solo trabajan con ficheros; no heredan conexiones abiertas a la BD
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+                futures = {executor.submit(export_item, task): task for task in tasks}
+                for future in as_completed(futures):
+                    try:
+                        objects += future.result()
+                        exported += 1
+                    except Exception as e:
+                        self.stderr.write(f"Error al exportar {futures[future][1]}: {e}")
+                        manifest.pop(re.sub(r"\.txt$", "", os.path.basename(futures[future][4])), None)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+        names = dict(Detections_DH.objects.values_list("class_id", "label").distinct()) or {0: FRACTURE, 1: CORE, 2: MARKER}
+        nc = max(names) + 1
+        # Con pocos sondeos puede no haber ninguno de validación: se valida con train
+        val = "images/val" if os.path.isdir(os.path.join(output, "images", "val")) else "images/train"
+        with open(os.path.join(output, "DH_dataset.yaml"), "w") as f:
+            f.write(f"path : {output}\ntrain : images/train\nval : {val}\n\n# classes\nnc: {nc}\n")
+            f.write(f"names : {[names.get(i, str(i)) for i in range(nc)]}\n")
+
+        self.stdout.write(f"{exported} imágenes exportadas ({objects} objetos), {len(manifest) - exported} sin cambios, "
+                          f"{removed} ficheros eliminados en {time.perf_counter() - start:.1f} s.")
+        self.stdout.write(f"Dataset: {os.path.join(output, 'DH_dataset.yaml')}")
@@ -0,0 +1,54 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, time
+from django.core.management.base import BaseCommand, CommandError
+from DH_app.models import Projects
+from DH_app.data.archive_import import import_archive, report_message
+
+
+'''
+Importa las imágenes de un fichero comprimido de una campaña en sus sondeos:
+    python manage.py import_archive campaña.zip --project Proyecto_1
+Las imágenes se asignan por carpeta (<sondeo>/...) o por nombre (<sondeo>_<n>.jpg) y las
+que ya están en el sondeo (mismo hash) se omiten, así que se puede repetir la importación.
+'''
+class Command(BaseCommand):
+    help = "Importa las imágenes de un fichero ZIP o TAR."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Fichero ZIP o TAR (.tar, .tar.gz, ...).")
+        parser.add_argument("--project", default=None, help="Buscar los sondeos solo en este proyecto.")
+        parser.add_argument("--workers", type=int, default=None, help="Hilos de escritura (por defecto UPLOAD_WORKERS).")
+
+    def handle(self, *args, **options):
+        if not os.path.isfile(options["path"]):
+            raise CommandError(f"El fichero {options['path']} no existe.")
+        if options["project"] and not Projects.objects.filter(project_name=options["project"]).exists():
+            raise CommandError(f"El proyecto {options['project']} no existe.")
+        start = time.perf_counter()
+        with open(options["path"], "rb") as f:
+            try:
+                # Sin segundo plano: el proceso termina al acabar el comando
+                report = import_archive(f, options["project"], options["workers"], background=False)
+            except ValueError as e:
+                raise CommandError(str(e))
+        for line in report_message(report):
+            self.stdout.write(line)
+        self.stdout.write(f"Tiempo: {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,124 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from DH_app.models import General_DH
+from DH_app.data.file_manager import create_directory
+from DH_app.data.manifest import sync_manifest, pending_images
+from DH_app.data.model_cache import model_version
+from DH_app.data.model_registry import active_model_path
+from DH_app.data.process_images import process_imgs
+
+
+def init_worker(threads):
+    # Hilos de torch por proceso para no saturar los núcleos
+    torch.set_num_threads(threads)
+
+
+def process_hole(DH_pk, model_path):
+    DH = General_DH.objects.get(ID=DH_pk)
+    path = create_directory(DH.project_id, DH.DH_id)
+    processed = [0]
+
+    def progress(count, total):
+        processed[0] = count
+
+    start = time.perf_counter()
+    process_imgs(path, model_path, progress=progress, DH=DH)
+    return DH.DH_id, processed[0], time.perf_counter() - start
+
+
+'''
+Procesa las imágenes pendientes de todos los sondeos (o de un proyecto) en paralelo:
+    python manage.py process_all --workers 4 --threads 2
+Las imágenes procesadas quedan registradas en el manifiesto, así que si se interrumpe
+basta con volver a ejecutar el comando para continuar.
+'''
+class Command(BaseCommand):
+    help = "Procesa las imágenes pendientes de todos los sondeos usando un pool de procesos."
+
+    def add_arguments(self, parser):
+        cpus = os.cpu_count() or 1
+        parser.add_argument("--project", default=None, help="Procesar solo los sondeos de este proyecto.")
+        parser.add_argument("--workers", type=int, default=max(1, cpus // 2), help="Número de procesos.")
+        parser.add_argument("--threads", type=int, default=None, help="Hilos de torch por proceso (por defecto núcleos / procesos).")
+        parser.add_argument("--sync", action="store_true", help="Sincronizar el manifiesto con las carpetas antes de empezar.")
+        parser.add_argument("--model", default=None, help="Path al modelo (por defecto el modelo activo de cada proyecto).")
+
+    def handle(self, *args, **options):
+        if options["model"] and not os.path.exists(options["model"]):
+            raise CommandError(f"El modelo {options['model']} no existe.")
+        workers = options["workers"]
+        threads = options["threads"] or max(1, (os.cpu_count() or 1) // workers)
+
+        holes = General_DH.objects.all()
+        if options["project"]:
+            holes = holes.filter(project_id=options["project"])
+        if options["sync"]:
+            for DH in holes:
+                path = create_directory(DH.project_id, DH.DH_id)
+                sync_manifest(DH, os.path.join(path, "images"))
+
+        pending, models = {}, {}
+        for DH in holes:
+            model_path = options["model"] or active_model_path(DH.project_id)
+            if not os.path.exists(model_path):
+                self.stderr.write(f"{DH.DH_id}: el modelo {model_path} no existe.")
+                continue
+            count = pending_images(DH, model_version(model_path)).count()
+            if count:
+                pending[DH.ID] = count
+                models[DH.ID] = model_path
+        if not pending:
+            self.stdout.write("No hay imágenes pendientes de procesar.")
+            return
+        self.stdout.write(f"{sum(pending.values())} imágenes pendientes en {len(pending)} sondeos "
+                          f"({workers} procesos x {threads} hilos).")
+
+        # Los procesos hijos abren sus propias conexiones a la BD
+        connections.close_all()
+        total_images, results = 0, []
+        start = time.perf_counter()
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(threads,))
+        try:
+            futures = {executor.submit(process_hole, pk, models[pk]): pk for pk in pending}
+            for future in as_completed(futures):
+                try:
+                    DH_id, images, seconds = future.result()
+                except Exception as e:
+                    self.stderr.write(f"Error en el sondeo {futures[future]}: {e}")
+                    continue
+                total_images += images
+                results.append((DH_id, images, seconds))
+                self.stdout.write(f"{DH_id}: {images} imágenes en {seconds:.1f} s")
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.stdout.write("Interrumpido. Vuelva a ejecutar el comando para continuar.")
+            raise
+        executor.shutdown()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"\n{'Sondeo':<20}{'imágenes':>10}{'s':>10}{'img/s':>10}")
+        for DH_id, images, seconds in sorted(results):
+            self.stdout.write(f"{DH_id:<20}{images:>10}{seconds:>10.1f}{images / max(seconds, 1e-9):>10.2f}")
+        self.stdout.write(f"\nTotal: {total_images} imágenes en {elapsed:.1f} s ({total_images / max(elapsed, 1e-9):.2f} img/s)")
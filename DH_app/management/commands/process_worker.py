@@ -0,0 +1,61 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import multiprocessing, socket, os
+from django.core.management.base import BaseCommand
+from django.db import connections
+from DH_app.data.jobs import work_threads, requeue_running
+
+
+'''
+Inicia los workers que procesan la cola de imágenes:
+    python manage.py process_worker --workers 2 --threads 4
+'''
+class Command(BaseCommand):
+    help = "Inicia los workers de procesado de imágenes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="Número de procesos worker.")
+        parser.add_argument("--poll", type=float, default=2, help="Segundos entre consultas a la cola.")
+        parser.add_argument("--threads", type=int, default=1, help="Trabajos simultáneos por proceso (ver DL_DYNAMIC_BATCHING).")
+
+    def handle(self, *args, **options):
+        # Solo los trabajos sin señal de vida: los de otros workers activos siguen en proceso
+        requeued = requeue_running()
+        if requeued:
+            self.stdout.write(f"{requeued} trabajos interrumpidos devueltos a la cola.")
+
+        # Cada proceso debe abrir su propia conexión a la BD
+        connections.close_all()
+        prefix = f"{socket.gethostname()}-{os.getpid()}-"
+        workers = []
+        for i in range(options["workers"]):
+            worker = multiprocessing.Process(target=work_threads, args=(f"{prefix}{i}", options["poll"], options["threads"]), daemon=True)
+            worker.start()
+            workers.append(worker)
+        self.stdout.write(f"{len(workers)} workers iniciados.")
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            requeue_running(prefix)
+            self.stdout.write("Workers detenidos.")
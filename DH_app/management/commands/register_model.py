@@ -0,0 +1,55 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+from django.core.management.base import BaseCommand, CommandError
+from DH_app.models import Projects
+from DH_app.data.model_registry import register_model, set_active
+
+
+'''
+Registra unos pesos en el almacén de modelos y opcionalmente los activa:
+    python manage.py register_model best.pt --name fracturas-v2 --default
+    python manage.py register_model best.pt --name fracturas-v2 --project Proyecto_1
+Los workers cargan el nuevo modelo activo en segundo plano (settings.DL_MODEL_POLL).
+'''
+class Command(BaseCommand):
+    help = "Registra un modelo de Deep Learning."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Fichero de pesos (.pt).")
+        parser.add_argument("--name", default=None, help="Nombre del modelo (por defecto el del fichero).")
+        parser.add_argument("--description", default="", help="Descripción del modelo.")
+        parser.add_argument("--default", action="store_true", help="Usar como modelo por defecto.")
+        parser.add_argument("--project", action="append", default=[], help="Activar el modelo en este proyecto (se puede repetir).")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.isfile(path):
+            raise CommandError(f"El fichero {path} no existe.")
+        for project in options["project"]:
+            if not Projects.objects.filter(project_name=project).exists():
+                raise CommandError(f"El proyecto {project} no existe.")
+
+        name = options["name"] or os.path.splitext(os.path.basename(path))[0]
+        model = register_model(path, name, options["description"], options["default"])
+        self.stdout.write(f"Modelo {model} registrado en {model.file}.")
+        for project in options["project"]:
+            set_active(project, model)
+            self.stdout.write(f"Modelo activo en el proyecto {project}.")
@@ -0,0 +1,56 @@
+"""
+Django web app to manage and store drillhole data.
+Copyright (C) 2023 Jorge Fuertes Blanco
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+from django.core.management.base import BaseCommand, CommandError
+from DH_app.models import General_DH, Projects
+from DH_app.data.file_manager import hole_directory
+from DH_app.data.manifest import sync_manifest
+
+
+'''
+Registra en la BD las imágenes que ya están en las carpetas de los sondeos:
+    python manage.py sync_images --project Proyecto_1
+Las vistas leen las imágenes de la BD, así que hay que ejecutarlo una vez con las imágenes
+subidas antes de registrarlas (o copiadas a mano en <sondeo>/images). Solo se calcula el
+hash de las imágenes nuevas o modificadas, así que se puede repetir.
+'''
+class Command(BaseCommand):
+    help = "Sincroniza la tabla de imágenes con las carpetas de los sondeos."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", default=None, help="Sincronizar solo los sondeos de este proyecto.")
+
+    def handle(self, *args, **options):
+        holes = General_DH.objects.all()
+        if options["project"]:
+            if not Projects.objects.filter(project_name=options["project"]).exists():
+                raise CommandError(f"El proyecto {options['project']} no existe.")
+            holes = holes.filter(project_id=options["project"])
+        total_updated, total_removed = 0, 0
+        for DH in holes:
+            images_path = os.path.join(hole_directory(DH.project_id, DH.DH_id), "images")
+            if not os.path.isdir(images_path):
+                continue
+            updated, removed = sync_manifest(DH, images_path)
+            if updated or removed:
+                self.stdout.write(f"{DH.DH_id}: {updated} registradas, {removed} eliminadas")
+            total_updated += updated
+            total_removed += removed
+        self.stdout.write(f"{total_updated} imágenes registradas, {total_removed} registros eliminados.")
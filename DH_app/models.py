@@ -19,6 +19,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from django.db import models
 from django.core import validators
+from django.contrib.auth.models import User
 from DH_app.custom_validators import UTM_Validator
 
 def image_directory_path(instance, filename):
@@ -30,6 +31,8 @@ def image_directory_path(instance, filename):
 class Projects(models.Model):
     project_name = models.CharField(primary_key=True,max_length=100, unique=True, help_text="Name of the project", blank=False, null=False)
     comments = models.TextField(max_length=1000, help_text="Description of the project", blank= True)
+    active_model = models.ForeignKey("DL_model", on_delete=models.SET_NULL, blank=True, null=True,
+                                     help_text="Model used to process the images of the project (default model if empty).")
     
     class Meta:
         verbose_name = "Proyecto"
@@ -113,6 +116,28 @@ class Images (models.Model):
     DH_id = models.ForeignKey(General_DH, on_delete=models.CASCADE, blank=False, null=False)
     project = models.ForeignKey(Projects, on_delete=models.CASCADE)
     Images = models.FileField(blank=False)
+    # Manifiesto de procesado: hash del contenido y versión del modelo con la que se procesó
+    content_hash = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the image file.")
+    source_hash = models.CharField(max_length=64, blank=True, db_index=True, help_text="SHA-256 of the original file if it was converted.")
+    file_size = models.BigIntegerField(blank=True, null=True)
+    mtime_ns = models.BigIntegerField(blank=True, null=True)
+    processed_hash = models.CharField(max_length=64, blank=True, help_text="Content hash of the processed image.")
+    model_version = models.CharField(max_length=64, blank=True, help_text="Model used to process the image.")
+    phash = models.CharField(max_length=16, blank=True, help_text="Perceptual hash of the image.")
+    width = models.IntegerField(blank=True, null=True, help_text="Image width in pixels.")
+    height = models.IntegerField(blank=True, null=True, help_text="Image height in pixels.")
+    uploaded = models.DateTimeField(auto_now_add=True, null=True)
+    processed_at = models.DateTimeField(blank=True, null=True, help_text="Date of the last processing.")
+    # Imagen sobre la que se hizo la inferencia (preprocesada): las detecciones están en sus coordenadas
+    input_width = models.IntegerField(blank=True, null=True, help_text="Width of the image used for inference.")
+    input_height = models.IntegerField(blank=True, null=True, help_text="Height of the image used for inference.")
+    input_transform = models.TextField(blank=True, help_text="3x3 matrix from image to inference coordinates (JSON).")
+    # Tramo del sondeo que aparece en la imagen
+    depth_from = models.FloatField(blank=True, null=True, validators=[validators.MinValueValidator(0)])
+    depth_to = models.FloatField(blank=True, null=True, validators=[validators.MinValueValidator(0)])
+
+    class Meta:
+        indexes = [models.Index(fields=["DH_id", "model_version"]), models.Index(fields=["DH_id", "depth_from"])]
 
 # Modelo de datos para el índice de litologías (Solo Admin)
 class Lithos(models.Model):
@@ -128,6 +153,14 @@ class Lithos(models.Model):
         verbose_name_plural = "Litologías"
         db_table = "DH_app_Lithos"
 
+# Último número de imagen asignado en cada sondeo (nombres <sondeo>_<n>.jpg)
+class Image_sequence(models.Model):
+    DH_id = models.OneToOneField(General_DH, on_delete=models.CASCADE, primary_key=True)
+    last = models.IntegerField(default=0, help_text="Last image number assigned.")
+
+    class Meta:
+        db_table = "DH_app_Image_sequence"
+
 # Modelo de datos para las litologías de los sondeos
 class Lithos_DH(models.Model):
     ID = models.AutoField(unique=True, primary_key=True)
@@ -142,3 +175,158 @@ class Lithos_DH(models.Model):
         verbose_name = "Litología sondeo"
         verbose_name_plural = "Litologías sondeos"
         db_table = "DH_app_Lithos_DH"
+
+
+# Modelo de datos para las detecciones del modelo de Deep Learning
+class Detections_DH(models.Model):
+    ID = models.AutoField(unique=True, primary_key=True)
+    DH_id = models.ForeignKey(General_DH, on_delete=models.CASCADE, blank=False, null=False)
+    image = models.ForeignKey(Images, on_delete=models.CASCADE, blank=False, null=False)
+    label = models.CharField(max_length=50, help_text="Class name.")
+    class_id = models.IntegerField()
+    confidence = models.FloatField(validators=[validators.MinValueValidator(0), validators.MaxValueValidator(1)])
+    x1 = models.FloatField()
+    y1 = models.FloatField()
+    x2 = models.FloatField()
+    y2 = models.FloatField()
+    mask_area = models.FloatField(default=0, help_text="Mask area (px).")
+    model_version = models.CharField(max_length=64, help_text="Hash of the model weights.")
+
+    class Meta:
+        verbose_name = "Detección"
+        verbose_name_plural = "Detecciones"
+        db_table = "DH_app_Detections_DH"
+        indexes = [models.Index(fields=["DH_id", "label"])]
+
+# Modelo de datos para el registro de fracturación (longitud de alta fracturación por tramo)
+class Fracture_DH(models.Model):
+    ID = models.AutoField(unique=True, primary_key=True)
+    DH_id = models.ForeignKey(General_DH, on_delete=models.CASCADE, blank=False, null=False)
+    From = models.FloatField(max_length=10,blank=False, null=False,
+                                validators=[validators.MinValueValidator(0)])
+    To = models.FloatField(max_length=10,blank=False, null=False,
+                                validators=[validators.MinValueValidator(0)])
+    fract_length = models.FloatField(help_text="High fracturing length in the interval (m).")
+    intensity = models.FloatField(help_text="High fracturing length per metre of core.",
+                                validators=[validators.MinValueValidator(0), validators.MaxValueValidator(1)])
+
+    class Meta:
+        verbose_name = "Fracturación sondeo"
+        verbose_name_plural = "Fracturación sondeos"
+        db_table = "DH_app_Fracture_DH"
+        indexes = [models.Index(fields=["DH_id", "From"])]
+
+# Modelo de datos para el RQD y la recuperación por tramo (calculados a partir de las máscaras de testigo)
+class RQD_DH(models.Model):
+    ID = models.AutoField(unique=True, primary_key=True)
+    DH_id = models.ForeignKey(General_DH, on_delete=models.CASCADE, blank=False, null=False)
+    From = models.FloatField(max_length=10,blank=False, null=False,
+                                validators=[validators.MinValueValidator(0)])
+    To = models.FloatField(max_length=10,blank=False, null=False,
+                                validators=[validators.MinValueValidator(0)])
+    core_length = models.FloatField(help_text="Recovered core length in the interval (m).")
+    recovery = models.FloatField(help_text="Recovered core length per metre.",
+                                validators=[validators.MinValueValidator(0), validators.MaxValueValidator(1)])
+    RQD = models.FloatField(help_text="Length of core pieces of at least RQD_MIN_PIECE per metre (%).",
+                                validators=[validators.MinValueValidator(0), validators.MaxValueValidator(100)])
+    pieces = models.IntegerField(default=0, help_text="Number of core pieces.")
+
+    class Meta:
+        verbose_name = "RQD sondeo"
+        verbose_name_plural = "RQD sondeos"
+        db_table = "DH_app_RQD_DH"
+        indexes = [models.Index(fields=["DH_id", "From"])]
+
+# Caché de detecciones por hash perceptual de la imagen
+class Results_cache(models.Model):
+    ID = models.AutoField(unique=True, primary_key=True)
+    DH_id = models.ForeignKey(General_DH, on_delete=models.CASCADE, null=True, blank=True)
+    content_hash = models.CharField(max_length=64, db_index=True, help_text="SHA-256 of the image file.")
+    phash = models.CharField(max_length=16, help_text="Perceptual hash of the image.")
+    model_version = models.CharField(max_length=64)
+    # Bandas de 16 bits del hash para buscar imágenes casi idénticas
+    band_0 = models.IntegerField(db_index=True)
+    band_1 = models.IntegerField(db_index=True)
+    band_2 = models.IntegerField(db_index=True)
+    band_3 = models.IntegerField(db_index=True)
+    detections = models.TextField(help_text="Detections with normalized coordinates (JSON).")
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Caché de detecciones"
+        verbose_name_plural = "Caché de detecciones"
+        db_table = "DH_app_Results_cache"
+        unique_together = ("DH_id", "content_hash", "model_version")
+
+# Modelo de datos para la cola de procesado de imágenes
+class Process_job(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATES = [(PENDING, "Pendiente"), (RUNNING, "En proceso"), (DONE, "Terminado"), (FAILED, "Error")]
+
+    ID = models.AutoField(unique=True, primary_key=True)
+    DH_id = models.ForeignKey(General_DH, on_delete=models.CASCADE, blank=False, null=False)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+    state = models.CharField(max_length=10, choices=STATES, default=PENDING, db_index=True)
+    total = models.IntegerField(default=0, help_text="Images to process.")
+    processed = models.IntegerField(default=0, help_text="Images already processed.")
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    model_version = models.CharField(max_length=64, blank=True, help_text="Model used by the job.")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True, help_text="Last sign of life of the worker.")
+
+    class Meta:
+        verbose_name = "Trabajo de procesado"
+        verbose_name_plural = "Trabajos de procesado"
+        db_table = "DH_app_Process_job"
+
+# Registro de modelos de Deep Learning (ficheros de pesos en MEDIA_ROOT/YOLO_models)
+class DL_model(models.Model):
+    ID = models.AutoField(unique=True, primary_key=True)
+    name = models.CharField(max_length=100, help_text="Model name.")
+    version = models.CharField(max_length=16, unique=True, help_text="First characters of the SHA-256 of the weights.")
+    checksum = models.CharField(max_length=64, help_text="SHA-256 of the weights file.")
+    file = models.CharField(max_length=500, help_text="Weights path relative to MEDIA_ROOT.")
+    size = models.BigIntegerField(help_text="Weights file size (bytes).")
+    description = models.TextField(blank=True)
+    is_default = models.BooleanField(default=False, help_text="Model used by the projects without an active model.")
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.version})"
+
+    class Meta:
+        verbose_name = "Modelo DL"
+        verbose_name_plural = "Modelos DL"
+        db_table = "DH_app_DL_model"
+
+# Sesiones de subida por partes (reanudables) de imágenes grandes
+class Upload_session(models.Model):
+    OPEN = "open"
+    COMPLETE = "complete"
+    FAILED = "failed"
+    STATES = [(OPEN, "Abierta"), (COMPLETE, "Completa"), (FAILED, "Error")]
+
+    ID = models.AutoField(unique=True, primary_key=True)
+    token = models.CharField(max_length=32, unique=True, help_text="Session identifier used in the upload URL.")
+    DH_id = models.ForeignKey(General_DH, on_delete=models.CASCADE, blank=False, null=False)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+    filename = models.CharField(max_length=255, help_text="Original file name.")
+    size = models.BigIntegerField(help_text="Total size (bytes).")
+    sha256 = models.CharField(max_length=64, help_text="SHA-256 declared by the client.")
+    offset = models.BigIntegerField(default=0, help_text="Bytes received.")
+    state = models.CharField(max_length=10, choices=STATES, default=OPEN, db_index=True)
+    image = models.CharField(max_length=500, blank=True, help_text="Stored image (relative to MEDIA_ROOT).")
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Subida por partes"
+        verbose_name_plural = "Subidas por partes"
+        db_table = "DH_app_Upload_session"
@@ -50,10 +50,21 @@ urlpatterns = [
 
     # Importar imágenes
     path("import_images/", upload_imgs, name = 'upload_imgs'),
+    # Subidas de imágenes por partes (reanudables)
+    path("upload_session/", upload_session, name = 'upload_session'),
+    path("upload_session/<str:token>/", upload_chunk, name = 'upload_chunk'),
+    # Importar imágenes desde un fichero comprimido
+    path("import_archive/", import_archive, name = 'import_archive'),
     # Ver imagenes del sondeo
     path("ShowImages/", show_images, name = 'show_images'),
     # Procesar imágenes
     path("ProcessImages/", process_images, name = 'process_images'),
+    # Imagen procesada dibujada bajo demanda
+    path("ShowOverlay/", show_overlay, name = 'show_overlay'),
+    # Estado del procesado de imágenes
+    path("ProcessStatus/", process_status, name = 'process_status'),
+    # Resumen de detecciones del sondeo
+    path("ShowDetections/", show_detections, name = 'show_detections'),
 
     # Muestras
     path("import_samples/", import_samples, name = 'import_samples'),
@@ -64,6 +75,10 @@ urlpatterns = [
     # Litologías
     path("import_litho/", import_litho, name = 'import_litho'),
     path("show_litho/", show_litho, name = 'show_litho'),
+    # Registro de fracturación
+    path("show_fractures/", show_fractures, name = 'show_fractures'),
+    # RQD y recuperación
+    path("show_rqd/", show_rqd, name = 'show_rqd'),
 
 
 
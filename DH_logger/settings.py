@@ -223,9 +223,55 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 # File upload configuration
-FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10 MB
-
-DL_MODEL_PATH = os.path.join(MEDIA_ROOT,"YOLO_models/default.pt") # Path al modelo
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(2.5 * 1024 * 1024)  # 2.5 MB, las subidas mayores se escriben en disco
+
+# Versiones reducidas de las imágenes para el visor
+THUMBNAIL_SIZE = 320 # Lado máximo de las miniaturas (px)
+WEB_IMAGE_SIZE = 1600 # Lado máximo de la versión web (px)
+THUMBNAIL_WORKERS = 4 # Hilos para generar las versiones reducidas
+UPLOAD_WORKERS = 8 # Hilos para guardar las imágenes subidas
+UPLOAD_MIN_SIDE = 32 # Lado mínimo de las imágenes subidas (px)
+UPLOAD_MAX_PIXELS = 200_000_000 # Número máximo de píxeles de las imágenes subidas
+ARCHIVE_MAX_MEMBER_SIZE = 200 * 1024 * 1024 # Tamaño máximo de cada imagen de un fichero comprimido (bytes)
+UPLOAD_SESSION_DIR = os.path.join(BASE_DIR, "upload_sessions") # Ficheros parciales de las subidas por partes
+UPLOAD_SESSION_MAX_SIZE = 512 * 1024 * 1024 # Tamaño máximo de un fichero subido por partes (bytes)
+UPLOAD_SESSION_EXPIRY = 72 # Horas sin actividad tras las que se borra una subida por partes incompleta
+PREPROCESS_IMAGES = True # Recortar, enderezar y normalizar las fotos de las cajas antes de la inferencia
+PREPROCESS_MAX_SIDE = 2048 # Lado máximo de la imagen preprocesada (px)
+PREPROCESS_MIN_AREA = 0.2 # Fracción mínima de la imagen que debe ocupar la caja detectada
+PREPROCESS_CLAHE_CLIP = 2.0 # Límite de contraste de la normalización de la iluminación (CLAHE)
+PREPROCESS_WORKERS = 4 # Hilos para el preprocesado
+
+DL_MODEL_PATH = os.path.join(MEDIA_ROOT,"YOLO_models/default.pt") # Path al modelo si no hay ninguno en el registro (DL_model)
+DL_MODEL_POLL = 30 # Segundos entre comprobaciones del modelo activo en los workers
+DL_JOB_HEARTBEAT = 30 # Segundos entre señales de vida de los trabajos en proceso
+DL_JOB_STALE = 300 # Segundos sin señal de vida tras los que un trabajo en proceso vuelve a la cola
+DL_MODEL_CACHE_SIZE = 2 # Número máximo de modelos cargados por worker
+DL_MODEL_CACHE_MAX_MB = 1024 # Memoria máxima de los modelos cargados por worker
+DL_MODEL_WARMUP = False # Precargar el modelo al arrancar la aplicación
+DL_BACKEND = "torch" # Backend de inferencia: "torch", "onnx" u "openvino" (si falla se usa "torch")
+DL_BATCH_SIZE = 8 # Imágenes por lote en el procesado
+DL_DYNAMIC_BATCHING = False # Agrupar las imágenes de trabajos concurrentes en un servidor de inferencia
+DL_SERVER_MAX_BATCH = 16 # Tamaño máximo de los micro-lotes del servidor de inferencia
+DL_SERVER_MAX_WAIT = 0.05 # Espera máxima (s) para completar un micro-lote
+DL_INFERENCE_SLOTS = 2 # Inferencias simultáneas en el servidor (todos los procesos)
+DL_THREADS_PER_SLOT = 4 # Hilos de torch de cada proceso worker
+DL_USER_QUOTA = 2 # Trabajos de procesado pendientes por usuario
+DL_MAX_QUEUED = 50 # Trabajos de procesado pendientes en total
+DL_LOCK_DIR = os.path.join(BASE_DIR, "locks") # Ficheros de bloqueo de la inferencia
+DL_INFERENCE_MODE = "full" # "full": imagen completa, "tiled": inferencia por teselas
+DL_TILE_SIZE = 640 # Tamaño de las teselas (px)
+DL_TILE_OVERLAP = 128 # Solape entre teselas (px)
+DL_TILE_MERGE_IOU = 0.5 # Solape mínimo para unir detecciones de teselas vecinas
+DL_STORE_MASKS = True # Guardar las máscaras de segmentación (1 bit por píxel) en <sondeo>/masks
+DL_EAGER_OVERLAYS = False # Escribir las imágenes processed_ al procesar (si no, se dibujan bajo demanda)
+OVERLAY_CACHE_DIR = os.path.join(BASE_DIR, "overlay_cache") # Caché de imágenes procesadas dibujadas bajo demanda
+OVERLAY_CACHE_MAX_MB = 2048 # Tamaño máximo de la caché (MB), se borran las menos usadas
+DL_RESULT_CACHE = True # Reutilizar las detecciones de imágenes repetidas (mismo SHA-256)
+DL_PHASH_DISTANCE = 0 # Distancia de Hamming máxima para reutilizar las de imágenes casi idénticas del mismo sondeo (0: desactivado, <= 3 garantiza encontrar el candidato)
+FRACTURE_LOG_STEP = 1.0 # Longitud de los tramos del registro de fracturación (m)
+RQD_STEP = 1.0 # Longitud de los tramos del RQD y la recuperación (m)
+RQD_MIN_PIECE = 0.1 # Longitud mínima de los trozos que cuentan para el RQD (m)
 
 # CSV Delimiter
 # CSV_DELIMITER = ";"